@@ -0,0 +1,423 @@
+"""离线基准测试：用进程内的假 PikPak API 和假 mikan RSS / 种子服务器运行 main() 的完整流程
+
+不访问真实的 PikPak 账号。可配置条目数、订阅数、API 延迟、错误率和限速，
+输出吞吐量、每个条目的 API 调用数和内存峰值，便于比较不同版本的性能。
+
+示例:
+    python benchmark.py --entries 10 100 1000 --feeds 1 50
+    python benchmark.py --entries 200 --latency 0.1 --error-rate 0.05 --api-rate 20 --json
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from email.utils import formatdate
+
+import httpx
+from pikpakapi.PikpakException import PikpakException
+from rich.console import Console
+from rich.table import Table
+
+import main
+
+BENCH_HOST = "bench.local"
+BENCH_ROOT_FOLDER = "root"
+console = Console()
+
+
+# 假 PikPak 文件的内容：由文件 ID 决定，便于校验下载结果
+def file_content(file_id, size):
+    block = hashlib.sha256(file_id.encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+# 进程内的假 PikPakApi，实现 main.py 用到的方法；可注入延迟、错误率和服务端限速
+class FakePikPakApi:
+    def __init__(self, username, latency=0.0, error_rate=0.0, rate_limit=0, download_size=0):
+        self.username = username
+        self.download_size = download_size  # 已完成任务的文件大小（与 FakeFeedServer 的 /file/ 一致）
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit  # 每秒允许的请求数，0 表示不限；超出时返回 "too frequent" 错误
+        self.access_token = "bench-token"
+        self.calls = {}  # 方法名 -> 调用次数
+        self.errors = 0
+        self.files = {}  # 文件 ID -> 文件信息
+        self.tasks = []
+        self.ids = itertools.count()
+        self.window = (0, 0)  # (当前秒, 本秒已处理的请求数)
+
+    # 模拟一次 API 请求：计数、限速、延迟和随机错误
+    async def request(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.rate_limit:
+            second = int(time.monotonic())
+            count = self.window[1] + 1 if self.window[0] == second else 1
+            self.window = (second, count)
+            if count > self.rate_limit:
+                self.errors += 1
+                raise PikpakException("operation is too frequent")
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise PikpakException("timeout: simulated server error")
+
+    def new_id(self, prefix):
+        return f"{prefix}{next(self.ids)}"
+
+    async def file_list(self, size=100, parent_id=None, next_page_token=None, additional_filters=None):
+        await self.request("file_list")
+        files = [f for f in self.files.values() if f["parent_id"] == parent_id]
+        name_filter = (additional_filters or {}).get("name", {}).get("eq")
+        if name_filter is not None:
+            files = [f for f in files if f["name"] == name_filter]
+        start = int(next_page_token or 0)
+        page = files[start:start + size]
+        return {"files": page, "next_page_token": str(start + size) if start + size < len(files) else ""}
+
+    async def create_folder(self, name="新建文件夹", parent_id=None):
+        await self.request("create_folder")
+        folder = {"id": self.new_id("folder-"), "name": name, "kind": "drive#folder", "parent_id": parent_id}
+        self.files[folder["id"]] = folder
+        return {"file": folder}
+
+    async def offline_download(self, file_url, parent_id=None, name=None):
+        await self.request("offline_download")
+        task_id = self.new_id("task-")
+        file_id = self.new_id("file-")
+        task_name = name or file_url.split("dn=")[-1].split("&")[0]
+        self.files[file_id] = {"id": file_id, "name": task_name, "kind": "drive#file", "parent_id": parent_id,
+                               "params": {"url": file_url}}
+        task = {"id": task_id, "name": task_name, "file_id": file_id, "phase": "PHASE_TYPE_RUNNING",
+                "progress": 0, "params": {"url": file_url}}
+        self.tasks.append(task)
+        return {"task": task}
+
+    async def offline_list(self, size=10000, next_page_token=None, phase=None):
+        await self.request("offline_list")
+        tasks = [t for t in self.tasks if phase is None or t["phase"] in phase]
+        start = int(next_page_token or 0)
+        page = tasks[start:start + size]
+        return {"tasks": page, "next_page_token": str(start + size) if start + size < len(tasks) else ""}
+
+    async def offline_task_retry(self, task_id):
+        await self.request("offline_task_retry")
+        return {}
+
+    async def offline_file_info(self, file_id):
+        await self.request("offline_file_info")
+        return self.files[file_id]
+
+    async def get_download_url(self, file_id):
+        await self.request("get_download_url")
+        content = file_content(file_id, self.download_size)
+        return {"web_content_link": f"http://{BENCH_HOST}/file/{file_id}", "size": str(len(content)),
+                "md5_checksum": hashlib.md5(content).hexdigest()}
+
+    async def refresh_access_token(self):
+        await self.request("refresh_access_token")
+
+    async def login(self):
+        await self.request("login")
+
+    def to_dict(self):
+        return {"username": self.username, "access_token": self.access_token}
+
+
+# 最小的 bencode 编码，用于生成假种子文件
+def bencode(value):
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    return b"d" + b"".join(bencode(key) + bencode(value[key]) for key in sorted(value)) + b"e"
+
+
+# 合成的 mikan 风格 RSS / 种子服务器，支持 ETag 条件请求；/file/<文件 ID> 提供支持 Range 的文件下载
+class FakeFeedServer:
+    def __init__(self, feeds, entries_per_feed, days=7, fetch_torrents=False, latency=0.0,
+                 download_size=0, ranges=True, drop_rate=0.0):
+        self.feeds = feeds
+        self.entries_per_feed = entries_per_feed
+        self.days = days
+        self.fetch_torrents = fetch_torrents  # True 时种子链接不含 infohash，需要下载种子文件
+        self.latency = latency
+        self.download_size = download_size
+        self.ranges = ranges  # False 时忽略 Range 请求头，总是返回 200 和完整文件
+        self.drop_rate = drop_rate  # 文件响应只返回一半内容（模拟连接中断）的概率，同一文件的同一区间只中断一次
+        self.dropped = set()
+        self.ranges_requested = []  # 收到的 Range 请求头
+        self.requests = {"rss": 0, "rss_not_modified": 0, "torrent": 0, "file": 0, "file_dropped": 0}
+
+    def feed_url(self, feed):
+        return f"http://{BENCH_HOST}/RSS/Bangumi?bangumiId={feed}"
+
+    def title(self, feed, index):
+        return f"[Bench] Show {feed} - {index:04d} [1080p][CHS]"
+
+    def infohash(self, feed, index):
+        return hashlib.sha1(f"{feed}/{index}".encode()).hexdigest()
+
+    def render_feed(self, feed):
+        items = []
+        for index in range(self.entries_per_feed):
+            day = index % self.days + 1
+            if self.fetch_torrents:
+                torrent_url = f"http://{BENCH_HOST}/torrent/{feed}/{index}.torrent"
+            else:
+                torrent_url = f"http://{BENCH_HOST}/Download/202401{day:02d}/{self.infohash(feed, index)}.torrent"
+            items.append(
+                f'<item><guid isPermaLink="false">{self.title(feed, index)}</guid>'
+                f"<link>http://{BENCH_HOST}/Home/Episode/{self.infohash(feed, index)}</link>"
+                f"<title>{self.title(feed, index)}</title>"
+                f'<enclosure type="application/x-bittorrent" length="1024" url="{torrent_url}" />'
+                f'<torrent xmlns="https://mikanani.me/0.1/"><link>{torrent_url}</link><contentLength>1024</contentLength>'
+                f"<pubDate>2024-01-{day:02d}T{index % 24:02d}:00:00</pubDate></torrent></item>"
+            )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+            f"<title>Mikan Project - Bench {feed}</title><link>http://{BENCH_HOST}/</link><description>bench</description>"
+            + "".join(items) + "</channel></rss>"
+        ).encode()
+
+    def render_torrent(self, feed, index):
+        return bencode({
+            "announce": "http://tracker.bench.local/announce",
+            "info": {
+                "name": self.title(feed, index),
+                "length": 1024 * 1024,
+                "piece length": 262144,
+                "pieces": hashlib.sha1(f"{feed}/{index}".encode()).digest() * 4,
+            },
+        })
+
+    async def handle(self, request: httpx.Request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = request.url.path
+        if path.startswith("/RSS/"):
+            feed = int(request.url.params["bangumiId"])
+            etag = f'"bench-{feed}-{self.entries_per_feed}"'
+            self.requests["rss"] += 1
+            if request.headers.get("if-none-match") == etag:
+                self.requests["rss_not_modified"] += 1
+                return httpx.Response(304, headers={"etag": etag})
+            return httpx.Response(200, content=self.render_feed(feed), headers={
+                "etag": etag, "last-modified": formatdate(usegmt=True), "content-type": "application/xml",
+            })
+        if path.startswith("/torrent/"):
+            self.requests["torrent"] += 1
+            feed, index = path[len("/torrent/"):-len(".torrent")].split("/")
+            return httpx.Response(200, content=self.render_torrent(int(feed), int(index)))
+        if path.startswith("/file/"):
+            return self.handle_file(request, path[len("/file/"):])
+        return httpx.Response(404)
+
+    def handle_file(self, request, file_id):
+        self.requests["file"] += 1
+        content = file_content(file_id, self.download_size)
+        status, headers = 200, {}
+        range_header = request.headers.get("range")
+        if range_header and self.ranges:
+            self.ranges_requested.append(range_header)
+            start, end = (int(value) for value in range_header[len("bytes="):].split("-"))
+            headers["content-range"] = f"bytes {start}-{end}/{len(content)}"
+            status, content = 206, content[start:end + 1]
+            key = (file_id, end)
+        else:
+            key = (file_id, None)
+        if self.drop_rate and key not in self.dropped and random.random() < self.drop_rate:
+            self.dropped.add(key)
+            self.requests["file_dropped"] += 1
+            content = content[:len(content) // 2]
+        return httpx.Response(status, content=content, headers=headers)
+
+
+# 按场景设置 main.py 的全局状态：内存状态数据库、假账号与假订阅
+def setup_scenario(args, feeds, entries):
+    main.console.quiet = True
+    main.open_state_db(":memory:")
+    main.open_lease_db()
+    main.FOLDER_CACHE.clear()
+    main.FEED_STATE.clear()
+    main._pending_feed_state.clear()
+    main._inflight_infohashes.clear()
+    main._cycle_timings.clear()
+    # 上一个场景的文件夹列表、查询、认领和退避状态属于另一个假 API 实例，不能带入本场景
+    main.LISTING_CACHE.entries.clear()
+    main._folder_lookups.clear()
+    main._claims.clear()
+    main._feed_backoff.clear()
+    main._triggered_feeds.clear()
+    main._token_renewals.clear()
+    main._task_progress.clear()
+    main.API_RATE_LIMIT = args.api_rate
+    main.API_RATE_BURST = max(args.api_rate * 2, 1)
+    main.API_CONCURRENCY = args.api_concurrency
+    main.RETRY_BASE_DELAY = args.retry_delay
+    # --download-size 大于 0 时在次轮之后把任务标记为完成，运行本地下载阶段
+    main.DOWNLOAD_DIR = None
+    if args.download_size:
+        main.DOWNLOAD_DIR = tempfile.mkdtemp(prefix="pikpak-bench-")
+        main.DOWNLOAD_SEGMENTS = args.download_segments
+        main.DOWNLOAD_MIN_SEGMENT_SIZE = max(1, args.download_size // args.download_segments)
+    main.USER[:] = [f"bench{i}@example.com" for i in range(args.accounts)]
+    main.PASSWORD[:] = ["bench"] * args.accounts
+    main.PATH[:] = [BENCH_ROOT_FOLDER] * args.accounts
+    main.LAST_REFRESH_TIME[:] = [0] * args.accounts  # 首轮会刷新一次 token
+    main.PIKPAK_CLIENTS[:] = [
+        FakePikPakApi(main.USER[i], args.latency, args.error_rate, args.server_rate_limit, args.download_size)
+        for i in range(args.accounts)
+    ]
+    main.TASK_INDEXES[:] = [None] * args.accounts
+    server = FakeFeedServer(
+        feeds, max(1, entries // feeds), fetch_torrents=args.fetch_torrents, latency=args.rss_latency,
+        download_size=args.download_size, ranges=not args.no_range, drop_rate=args.download_drop_rate,
+    )
+    main.FEEDS[:] = [{"url": server.feed_url(feed), "account": None, "path": None} for feed in range(feeds)]
+    return server
+
+
+# 运行一轮 main()，返回耗时
+async def run_cycle(server):
+    main.HTTP_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(server.handle))
+    start = time.perf_counter()
+    await main.main()
+    return time.perf_counter() - start
+
+
+# 把所有假任务标记为完成，运行一次任务状态轮询并等待本地下载结束，返回耗时
+async def run_download_cycle(server):
+    for client in main.PIKPAK_CLIENTS:
+        for task in client.tasks:
+            task.update(phase="PHASE_TYPE_COMPLETE", progress=100)
+    main.init_scheduler()
+    main.DOWNLOAD_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(server.handle))
+    start = time.perf_counter()
+    try:
+        await main.track_tasks()
+        await asyncio.gather(*main._download_jobs)
+    finally:
+        await main.close_http_client()
+    return time.perf_counter() - start
+
+
+# DOWNLOAD_DIR 中已下载完成的文件总大小
+def downloaded_bytes():
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(main.DOWNLOAD_DIR) for name in names if not name.endswith(".part")
+    )
+
+
+# 运行一个场景：首轮（全部为新条目）和次轮（RSS 未变化）
+def run_scenario(args, feeds, entries):
+    server = setup_scenario(args, feeds, entries)
+    total_entries = server.entries_per_feed * feeds
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    cold = asyncio.run(run_cycle(server))
+    _, cold_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    warm = asyncio.run(run_cycle(server))
+    _, warm_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    download = {}
+    if main.DOWNLOAD_DIR:
+        try:
+            seconds = asyncio.run(run_download_cycle(server))
+            size = downloaded_bytes()
+            download = {
+                "download_seconds": round(seconds, 3),
+                "downloaded_bytes": size,
+                "download_mb_per_second": round(size / 1024 / 1024 / seconds, 1) if seconds else None,
+            }
+        finally:
+            shutil.rmtree(main.DOWNLOAD_DIR, ignore_errors=True)
+
+    clients = main.PIKPAK_CLIENTS
+    api_calls = sum(sum(client.calls.values()) for client in clients)
+    calls_by_method = {}
+    for client in clients:
+        for method, count in client.calls.items():
+            calls_by_method[method] = calls_by_method.get(method, 0) + count
+    submitted = sum(len(client.tasks) for client in clients)
+    return {
+        "feeds": feeds,
+        "entries": total_entries,
+        "accounts": len(clients),
+        "submitted": submitted,
+        "cold_seconds": round(cold, 3),
+        "warm_seconds": round(warm, 3),
+        "entries_per_second": round(total_entries / cold, 1) if cold else None,
+        "api_calls": api_calls,
+        "api_calls_per_entry": round(api_calls / total_entries, 2) if total_entries else None,
+        "api_errors": sum(client.errors for client in clients),
+        "calls_by_method": calls_by_method,
+        "rss_requests": server.requests,
+        "peak_memory_kb": round(max(cold_peak, warm_peak) / 1024, 1),
+        **download,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PikPak RSS 下载器离线基准测试（假 PikPak API + 假 RSS 服务器）")
+    parser.add_argument("--entries", type=int, nargs="+", default=[10, 100, 1000], help="每轮的条目总数（平均分配到各订阅）")
+    parser.add_argument("--feeds", type=int, nargs="+", default=[1, 10], help="订阅数")
+    parser.add_argument("--accounts", type=int, default=1, help="假 PikPak 账号数")
+    parser.add_argument("--latency", type=float, default=0.05, help="假 PikPak API 的平均延迟（秒）")
+    parser.add_argument("--rss-latency", type=float, default=0.02, help="假 RSS / 种子服务器的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="假 PikPak API 返回临时错误的概率")
+    parser.add_argument("--server-rate-limit", type=int, default=0, help="假 PikPak API 每秒允许的请求数（0 表示不限）")
+    parser.add_argument("--api-rate", type=float, default=main.API_RATE_LIMIT, help="客户端 API 限速（每秒请求数）")
+    parser.add_argument("--api-concurrency", type=int, default=main.API_CONCURRENCY, help="客户端 API 并发数")
+    parser.add_argument("--retry-delay", type=float, default=main.RETRY_BASE_DELAY, help="重试退避基准时间（秒）")
+    parser.add_argument("--fetch-torrents", action="store_true", help="种子链接不含 infohash，需要下载并解析种子文件")
+    parser.add_argument("--download-size", type=int, default=0, help="已完成任务的文件大小（字节），大于 0 时运行本地下载阶段")
+    parser.add_argument("--download-segments", type=int, default=main.DOWNLOAD_SEGMENTS, help="每个文件的下载分段数")
+    parser.add_argument("--download-drop-rate", type=float, default=0.0, help="文件响应中途断开的概率（测试分段重试）")
+    parser.add_argument("--no-range", action="store_true", help="假服务器不支持 Range 请求（测试单连接回退）")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--json", action="store_true", help="以 JSON Lines 输出结果")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    results = []
+    for feeds, entries in itertools.product(args.feeds, args.entries):
+        result = run_scenario(args, feeds, entries)
+        results.append(result)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    if not args.json:
+        table = Table(title="基准测试结果", show_header=True, header_style="bold magenta")
+        columns = ["订阅", "条目", "提交", "首轮 (s)", "次轮 (s)", "条目/秒", "API 调用/条目", "API 错误", "内存峰值 (KB)"]
+        if args.download_size:
+            columns += ["下载 (s)", "下载 MB/s"]
+        for column in columns:
+            table.add_column(column, justify="right")
+        for result in results:
+            row = [
+                str(result["feeds"]), str(result["entries"]), str(result["submitted"]),
+                f"{result['cold_seconds']:.2f}", f"{result['warm_seconds']:.2f}", str(result["entries_per_second"]),
+                str(result["api_calls_per_entry"]), str(result["api_errors"]), f"{result['peak_memory_kb']:.0f}",
+            ]
+            if args.download_size:
+                row += [f"{result['download_seconds']:.2f}", str(result["download_mb_per_second"])]
+            table.add_row(*row)
+        console.print(table)
@@ -1,208 +1,1701 @@
 import asyncio
-import feedparser
+import base64
+import calendar
+import hashlib
+import importlib.util
 import os
+import random
+import re
 import signal
+import socket
+import sqlite3
 import sys
+import threading
 import time
-import httpx
+from datetime import datetime, timezone
 import json
-from pikpakapi import PikPakApi
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.table import Table
-from rich.progress import Progress
+import urllib.parse
+from collections import OrderedDict
+from http import HTTPStatus
 import logging
+import argparse
+import functools
+import traceback
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from rich.progress import Progress
 
 
 CONFIG_FILE = "config.json"     # 配置文件（保存基本配置）
+STATE_DB_FILE = "state.db"    # 状态数据库（条目生命周期、客户端 token、文件夹缓存、RSS 轮询状态）
+# 旧版状态文件，首次运行时导入 STATE_DB_FILE
 CLIENT_STATE_FILE = "pikpak.json"    # 客户端状态文件（保存 PikPakApi 登录状态及 token 等信息）
+FOLDER_CACHE_FILE = "folders.json"   # 文件夹缓存文件（保存 (父文件夹 ID, 日期) 到文件夹 ID 的映射）
+FEED_STATE_FILE = "feeds.json"   # RSS 轮询状态文件（保存 ETag / Last-Modified 及已处理条目水位线）
+TORRENT_DIR = "torrent"   # 旧版以种子文件是否存在作为去重依据的目录
+SAVE_TORRENT_FILES = False  # 是否将下载的种子文件另存到 TORRENT_DIR（配置项 save_torrents，去重不依赖这些文件）
+MAGNET_MAX_TRACKERS = 10  # 磁力链接中附带的 tracker 数量上限
+TORRENT_SPOOL_SIZE = 1024 * 1024  # 另存种子文件时，超过该大小的种子边下载边在线程中写入临时文件
+PROGRESS_REFRESH_INTERVAL = 0.2  # 汇总进度条的最短刷新间隔（秒）
 
-# 全局变量（由配置文件或手动填写）
+# 全局变量（由配置文件或手动填写），每个 PikPak 账号占用各列表中的同一个下标
 USER = [""]
 PASSWORD = [""]
-PATH = [""]
-RSS = [""]
-INTERVAL_TIME_RSS = 600  # rss 检查间隔
+PATH = [""]  # 账号的默认保存路径（文件夹 ID）
+FEEDS = []  # RSS 订阅: {"url": 链接, "account": 账号下标 (None 表示自动分配), "path": 保存路径 (None 表示账号默认路径)}
+INTERVAL_TIME_RSS = 600  # rss 检查间隔（订阅的发布规律样本不足时使用）
+FEED_MIN_INTERVAL = 60  # 预计发布时段内的轮询间隔（秒，配置项 rss_min_interval）
+FEED_MAX_INTERVAL = 3600  # 空闲时段指数退避的最长间隔（秒，配置项 rss_max_interval）
+FEED_WINDOW_BEFORE = 600  # 预计发布时间之前多少秒开始密集轮询
+FEED_WINDOW_AFTER = 3600  # 预计发布时间之后继续密集轮询多久（发布常有延迟）
+FEED_CADENCE_PERIOD = 7 * 86400  # 发布周期（番剧通常每周一集）
+FEED_CADENCE_MIN_SAMPLES = 3  # 至少有这么多发布时间样本才按规律调度
+FEED_HISTORY_SIZE = 32  # 每个订阅保留的发布时间样本数
+FEED_TRIGGER = None  # 外部触发立即轮询（HTTP POST /poll）
+_triggered_feeds = set()  # 被触发的订阅下标
+_feed_backoff = {}  # 订阅链接 -> 连续没有新条目的轮询次数
 INTERVAL_TIME_REFRESH = 21600  # token 刷新间隔
+INTERVAL_TIME_TOKEN_CHECK = 300  # 检查 token 是否需要刷新的间隔
+TOKEN_REFRESH_MARGIN = 900  # 在 access token 过期前多少秒提前刷新（应大于 INTERVAL_TIME_TOKEN_CHECK）
+_token_renewals = {}  # 账号下标 -> 正在进行的 token 刷新 / 重新登录，供并发请求共享
+TRACKER_MIN_INTERVAL = 30  # 有进行中的离线任务时的状态轮询间隔（秒）
+TRACKER_MAX_INTERVAL = 1800  # 没有进行中的任务时逐步退避到的最长轮询间隔（秒）
+TASK_MAX_RETRIES = 2  # 离线任务出错后自动重试的次数
+TASK_MAX_MISSES = 3  # 跟踪的任务连续这么多次不在完整的任务列表中（已被删除或清理）时停止跟踪
+ON_COMPLETE_COMMAND = None  # 离线任务完成时执行的命令（配置项 on_complete），任务信息通过环境变量传入
+COMPLETION_HOOKS = []  # 离线任务完成时调用的协程函数 hook(entry, task)
+TRACKER_WAKEUP = None  # 有新任务提交时唤醒状态轮询
+_task_progress = {}  # 任务 ID -> 上次汇报的进度
+
+# 本地下载：离线任务完成后用多段并发的 HTTP Range 请求把文件拉取到本地（配置项 download_dir 为空时不下载）
+DOWNLOAD_DIR = None  # 本地保存目录（配置项 download_dir）
+DOWNLOAD_SEGMENTS = 4  # 每个文件的并发分段数（配置项 download_segments）
+DOWNLOAD_MIN_SEGMENT_SIZE = 8 * 1024 * 1024  # 分段的最小大小，小文件不再拆分
+DOWNLOAD_CONCURRENCY = 2  # 同时下载的文件数
+DOWNLOAD_BANDWIDTH_LIMIT = 0  # 全局下载带宽上限（字节/秒，0 表示不限，配置项 download_bandwidth）
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # 每次读取和写入的块大小
+DOWNLOAD_CHECKPOINT_BYTES = 4 * 1024 * 1024  # 每下载这么多字节持久化一次分段进度
+DOWNLOAD_SEMAPHORE = None
+DOWNLOAD_RATE_LIMITER = None
+_download_jobs = set()  # 正在进行的下载任务
+SHUTDOWN_TIMEOUT = 60  # 退出时等待进行中的提交完成的最长时间（秒）
 PIKPAK_CLIENTS = [""]
-last_refresh_time = 0
+TASK_INDEXES = [None]  # 每轮检查的离线任务索引快照
+LAST_REFRESH_TIME = [0]
+FOLDER_CACHE = {}  # "父文件夹ID/名称" -> 文件夹 ID
+_folder_lookups = {}  # 正在进行的文件夹查询，供并发条目共享
+LISTING_PAGE_SIZE = 100  # file_list 每页数量
+LISTING_CACHE_TTL = 300  # 文件夹内容缓存的有效期（秒）
+LISTING_CACHE_SIZE = 256  # 最多缓存的文件夹列表数（LRU 淘汰）
+_inflight_infohashes = set()  # 正在处理的 infohash，防止同一轮中不同订阅的相同种子重复提交
+
+# 多实例协调：网络阶段之前按条目认领带租期的 lease，处理期间定期续租；实例崩溃后 lease 过期，由其他实例接管
+LEASE_DB_FILE = None  # 多台主机共享的 SQLite 文件（配置项 lease_db），None 表示存放在状态数据库中（共用同一个状态数据库的实例）
+LEASE_DB = None  # lease 存储的专用连接，只在工作线程中使用
+LEASE_LOCK = threading.Lock()
+LEASE_TTL = 120  # 租期（秒，配置项 lease_ttl），处理期间每隔 1/3 租期续租一次
+LEASE_BUSY_TIMEOUT = 30.0  # 共享文件被其他实例锁定时的等待时间（秒）
+LEASE_DONE_RETENTION = 7 * 86400  # 已提交的认领保留多久，防止其他实例凭旧的任务列表快照重复提交
+CLAIM_BATCH = 0  # 每轮最多认领的条目数（配置项 claim_batch，0 表示不限），多个实例据此分摊积压
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"  # 实例标识（配置项 instance_id）
+LEASE_CLAIMED = "claimed"  # 本实例取得 lease
+LEASE_HELD = "held"  # 其他实例正在处理
+LEASE_DONE = "done"  # 其他实例已提交
+_claims = {}  # 条目 guid -> 本轮认领的 key
+FEED_STATE = {}  # RSS 链接 -> 已提交的轮询状态
+_pending_feed_state = {}  # 本轮解析得到、尚未提交的轮询状态
+
+# 订阅过滤：解析标题（番剧名、集数、版本、分辨率、字幕组、语言），按包含 / 排除规则过滤，并且同一集只保留最优版本
+FILTER_INCLUDE = []  # 所有订阅共用的包含规则（正则，配置项 filters.include）
+FILTER_EXCLUDE = []  # 所有订阅共用的排除规则（正则，配置项 filters.exclude）
+BEST_RELEASE_ONLY = True  # 同一番剧同一集只保留最优版本（配置项 best_release）
+PREFER_RESOLUTION = []  # 分辨率偏好，靠前优先，如 [1080, 2160, 720]；为空时分辨率越高越好（配置项 prefer_resolution）
+PREFER_LANGUAGE = []  # 字幕语言偏好，靠前优先，如 ["chs", "cht"]（配置项 prefer_language）
+TITLE_GROUP_PATTERN = re.compile(r"^\s*[\[【]([^\]】]+)[\]】]")
+TITLE_NOISE_PATTERN = re.compile(r"★[^★]*★")
+TITLE_EPISODE_PATTERNS = [
+    re.compile(r"\s-\s*(\d{1,4})(?:v(\d+))?(?=\s|[\[【(（]|$|END)", re.IGNORECASE),
+    re.compile(r"[\[【]\s*(\d{1,4})(?:v(\d+))?(?:\s*(?:END|完|Fin))?\s*[\]】]", re.IGNORECASE),
+    re.compile(r"第\s*(\d{1,4})\s*[话話集]()"),
+]
+TITLE_BRACKET_PATTERN = re.compile(r"[\[【]([^\]】]*)[\]】]")
+TITLE_RESOLUTION_PATTERN = re.compile(r"(?:\d{3,4}[x×])?(\d{3,4})[pP]?(?=[^\d]|$)|(4K)", re.IGNORECASE)
+TITLE_LANGUAGE_PATTERNS = {
+    "chs": re.compile(r"CHS|GB|简|SC(?![a-z])", re.IGNORECASE),
+    "cht": re.compile(r"CHT|BIG5|繁|TC(?![a-z])", re.IGNORECASE),
+}
+KNOWN_RESOLUTIONS = {360, 480, 540, 576, 720, 1080, 1440, 2160}
+
+# 网络阶段调度：种子下载与 PikPak API 调用分别限制并发，API 调用共享令牌桶限速
+TORRENT_CONCURRENCY = 4  # 同时下载的种子数
+API_CONCURRENCY = 4  # 同时进行的 PikPak API 调用数
+API_RATE_LIMIT = 5  # PikPak API 每秒请求数
+API_RATE_BURST = 10  # PikPak API 突发请求数
+RETRY_ATTEMPTS = 4  # 临时错误（超时、429、5xx）的最大尝试次数
+API_WRITE_METHODS = {"offline_download", "create_folder"}  # 不幂等的 PikPak API：超时或 5xx 时请求可能已生效，不自动重试
+RETRY_BASE_DELAY = 1.0  # 重试退避基准时间（秒）
+RETRY_MAX_DELAY = 30.0  # 重试退避上限（秒）
+MAX_RETRY_CYCLES = 5  # 失败条目最多顺延到后续几轮检查
+TORRENT_SEMAPHORE = None
+API_SEMAPHORE = None
+API_RATE_LIMITER = None
+
+# 共享 HTTP 连接池（RSS 与种子下载共用，复用 DNS / TCP / TLS 连接）
+HTTP_MAX_CONNECTIONS = 20  # 连接池最大连接数
+HTTP_MAX_KEEPALIVE = 10  # 保持空闲的长连接数
+HTTP_KEEPALIVE_EXPIRY = 30.0  # 空闲连接保留时间（秒）
+HTTP_TIMEOUTS = {"connect": 10.0, "read": 60.0, "write": 30.0, "pool": 30.0}  # 各阶段超时（秒）
+HTTP_CLIENT = None
+DOWNLOAD_CLIENT = None  # 本地下载专用的 HTTP/1.1 连接池（HTTP/2 会把所有分段复用到同一个 TCP 连接上）
+
+# 监控指标：各阶段耗时直方图、计数器和队列深度，通过本地 HTTP 服务的 /metrics 以 Prometheus 文本格式暴露
+METRICS_HOST = "127.0.0.1"  # 监控服务监听地址（配置项 metrics_host）
+METRICS_PORT = None  # 监控服务端口，None 表示不启动（配置项 metrics_port）
+CYCLE_SUMMARY = False  # 每轮 RSS 检查结束后输出各阶段耗时汇总（配置项 cycle_summary）
+METRICS = {}  # 指标名 -> 指标
+HTTP_ROUTES = {}  # (方法, 路径) -> 处理函数，返回 (状态码, Content-Type, 内容)
+_cycle_timings = {}  # 本轮各阶段耗时: 阶段 -> [次数, 总耗时, 最长耗时]
+
+# 构建任务索引时拉取的离线任务状态（默认的 offline_list 只返回运行中和失败的任务）
+TASK_INDEX_PHASES = ["PHASE_TYPE_PENDING", "PHASE_TYPE_RUNNING", "PHASE_TYPE_COMPLETE", "PHASE_TYPE_ERROR"]
+ACTIVE_TASK_PHASES = {"PHASE_TYPE_PENDING", "PHASE_TYPE_RUNNING"}  # 计入账号负载的任务状态
+
+# 条目生命周期状态
+ENTRY_SEEN = "seen"
+ENTRY_TORRENT_FETCHED = "torrent_fetched"
+ENTRY_FOLDER_RESOLVED = "folder_resolved"
+ENTRY_TASK_SUBMITTED = "task_submitted"
+ENTRY_TASK_COMPLETED = "task_completed"
+ENTRY_FAILED = "failed"
+ENTRY_FILTERED = "filtered"  # 被订阅过滤规则或同集更优版本排除
+STATE_DB = None
+
+# 首次使用时才导入 rich 并创建 Console；无终端模式下会被 HeadlessConsole 替换，不必加载 rich
+class LazyConsole:
+    def __init__(self):
+        object.__setattr__(self, "_console", None)
+
+    @property
+    def rich(self):
+        if self._console is None:
+            from rich.console import Console
+            object.__setattr__(self, "_console", Console())
+        return self._console
+
+    def __getattr__(self, name):
+        return getattr(self.rich, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.rich, name, value)
+
 
 # Initialize Rich Console
-console = Console()
+console = LazyConsole()
+
+# 无终端模式（--headless，或标准输出不是终端时默认启用）：不做任何 Rich 渲染，以 JSON Lines 输出结构化事件
+HEADLESS = False
+EVENT_RATE_LIMIT = 20  # 每种事件每秒最多输出的条数，超出的被丢弃并在下一条中计数
+EVENT_RATE_BURST = 100
+EVENT_LOGGER = logging.getLogger("rss-pikpak")
+# 单次运行（--once，供 cron / systemd timer 调用）：执行一轮检查后以退出码结束，不做交互输入
+ONE_SHOT = False
+EXIT_FAILED = 1  # 有订阅获取失败或条目处理失败（失败条目会在下次运行时重试）
+EXIT_CONFIG_ERROR = 2  # 配置不完整且无法交互补全
+CYCLE_FAILURES = 0  # 本轮失败的订阅数和条目数
+CONSOLE_MARKUP_PATTERN = re.compile(r"\[/?(?:bold |dim )?(?:red|green|yellow|blue|cyan|magenta|bold|dim|link)(?:=[^\]]*)?\]")
+
+
+CLAIMS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_claims_owner ON claims (owner);
+"""
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    guid TEXT PRIMARY KEY,
+    infohash TEXT,
+    torrent_name TEXT,
+    title TEXT,
+    state TEXT NOT NULL,
+    account TEXT,
+    folder_id TEXT,
+    task_id TEXT,
+    file_id TEXT,
+    task_retries INTEGER NOT NULL DEFAULT 0,
+    task_misses INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    release_key TEXT,
+    data TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_infohash ON entries (infohash);
+CREATE INDEX IF NOT EXISTS idx_entries_torrent_name ON entries (torrent_name);
+CREATE INDEX IF NOT EXISTS idx_entries_state ON entries (state);
+CREATE INDEX IF NOT EXISTS idx_entries_task_id ON entries (task_id);
+CREATE TABLE IF NOT EXISTS clients (
+    username TEXT PRIMARY KEY,
+    last_refresh_time REAL NOT NULL DEFAULT 0,
+    client_token TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS folders (
+    key TEXT PRIMARY KEY,
+    folder_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS feeds (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    watermark REAL,
+    seen TEXT NOT NULL DEFAULT '[]',
+    cadence TEXT
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    segments TEXT NOT NULL,
+    account TEXT,
+    file_id TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deferred (
+    instance TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (instance, guid)
+);
+""" + CLAIMS_SCHEMA
+
+
+# 打开状态数据库（WAL 模式），建表并在首次运行时导入旧版状态文件
+def open_state_db(path=None):
+    global STATE_DB
+    STATE_DB = sqlite3.connect(path or STATE_DB_FILE, isolation_level=None, check_same_thread=False)
+    STATE_DB.row_factory = sqlite3.Row
+    STATE_DB.execute("PRAGMA journal_mode=WAL")
+    STATE_DB.execute("PRAGMA synchronous=NORMAL")
+    STATE_DB.executescript(STATE_DB_SCHEMA)
+    # 旧版数据库缺少的列
+    columns = {row["name"] for row in STATE_DB.execute("PRAGMA table_info(entries)")}
+    for column, definition in (("file_id", "TEXT"), ("task_retries", "INTEGER NOT NULL DEFAULT 0"), ("task_misses", "INTEGER NOT NULL DEFAULT 0"), ("release_key", "TEXT")):
+        if column not in columns:
+            STATE_DB.execute(f"ALTER TABLE entries ADD COLUMN {column} {definition}")
+    STATE_DB.execute("CREATE INDEX IF NOT EXISTS idx_entries_release_key ON entries (release_key)")
+    if "cadence" not in {row["name"] for row in STATE_DB.execute("PRAGMA table_info(feeds)")}:
+        STATE_DB.execute("ALTER TABLE feeds ADD COLUMN cadence TEXT")
+    if kv_get("migrated") is None:
+        migrate_legacy_state()
+
+
+# 读取 / 写入 kv 表中的 JSON 值
+def kv_get(key, default=None):
+    row = STATE_DB.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+    return json.loads(row["value"]) if row else default
+
+
+def kv_set(key, value):
+    STATE_DB.execute(
+        "INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        (key, json.dumps(value, ensure_ascii=False)),
+    )
+
+
+# 旧版文件名形如 <40 位 infohash>.torrent（mikan 的种子链接即如此），从中取出 infohash
+def infohash_from_name(name):
+    stem = name.rsplit('.', 1)[0].lower()
+    return stem if re.fullmatch(r"[0-9a-f]{40}", stem) else None
+
+
+# 读取旧版 JSON 状态文件，不存在或损坏时返回 None
+def load_legacy_json(file_name):
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with open(file_name, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        console.log(f"[yellow]导入 {file_name} 失败: {str(e)}[/yellow]")
+        return None
+
+
+# 导入旧版 JSON 状态文件及 torrent/ 目录（旧文件保留不删除）
+def migrate_legacy_state():
+    imported = []
+    with STATE_DB:
+        STATE_DB.execute("BEGIN")
+        if os.path.exists(CLIENT_STATE_FILE):
+            try:
+                for username, state in load_client_states().items():
+                    store_client_state(username, state.get("last_refresh_time", 0), state.get("client_token", {}))
+                imported.append(CLIENT_STATE_FILE)
+            except Exception as e:
+                console.log(f"[yellow]导入 {CLIENT_STATE_FILE} 失败: {str(e)}[/yellow]")
+        folders = load_legacy_json(FOLDER_CACHE_FILE)
+        if folders:
+            STATE_DB.executemany("INSERT OR REPLACE INTO folders (key, folder_id) VALUES (?, ?)", folders.items())
+            imported.append(FOLDER_CACHE_FILE)
+        feeds = load_legacy_json(FEED_STATE_FILE)
+        for url, state in (feeds or {}).items():
+            store_feed_state(url, state)
+        if feeds:
+            imported.append(FEED_STATE_FILE)
+        if os.path.isdir(TORRENT_DIR):
+            names = [name for name in os.listdir(TORRENT_DIR) if not name.startswith('.')]
+            now = time.time()
+            STATE_DB.executemany(
+                "INSERT OR IGNORE INTO entries (guid, infohash, torrent_name, title, state, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(f"torrent:{name}", infohash_from_name(name), name, name, ENTRY_TASK_SUBMITTED, now) for name in names],
+            )
+            imported.append(f"{TORRENT_DIR}/ ({len(names)} 个种子)")
+        kv_set("migrated", time.time())
+    if imported:
+        console.log(f"[green]已将旧版状态导入 {STATE_DB_FILE}: {', '.join(imported)}[/green]")
+
+
+# 以 (guid / infohash / 种子文件名) 查找条目记录
+def find_entry_record(entry):
+    name = entry['torrent'].split('/')[-1]
+    infohash = entry.get('infohash') or infohash_from_name(name)
+    return STATE_DB.execute(
+        "SELECT * FROM entries WHERE guid = ? OR torrent_name = ? OR (infohash IS NOT NULL AND infohash = ?) "
+        "ORDER BY updated_at DESC LIMIT 1",
+        (entry['guid'], name, infohash),
+    ).fetchone()
+
+
+# 是否已有其他条目以相同的 infohash 提交过离线任务（例如同一种子出现在另一个字幕组的订阅中）
+def infohash_is_done(infohash, guid):
+    return STATE_DB.execute(
+        "SELECT 1 FROM entries WHERE infohash = ? AND guid != ? AND state IN (?, ?) LIMIT 1",
+        (infohash, guid, ENTRY_TASK_SUBMITTED, ENTRY_TASK_COMPLETED),
+    ).fetchone() is not None
+
+
+# 条目是否已经处理完毕（已提交 / 已完成，或多次失败后放弃）
+def entry_is_done(entry):
+    record = find_entry_record(entry)
+    if record is None:
+        return False
+    if record["state"] in (ENTRY_TASK_SUBMITTED, ENTRY_TASK_COMPLETED):
+        return True
+    return record["state"] == ENTRY_FAILED and record["retries"] >= MAX_RETRY_CYCLES
+
+
+# 记录条目进入新的生命周期状态，fields 为需要同时更新的列
+def record_entry(entry, state, **fields):
+    name = entry['torrent'].split('/')[-1]
+    values = {
+        "guid": entry['guid'],
+        "infohash": entry.get('infohash') or infohash_from_name(name),
+        "torrent_name": name,
+        "title": entry['title'],
+        "state": state,
+        "release_key": (entry.get('release') or {}).get('key'),
+        "data": json.dumps(entry, ensure_ascii=False),
+        "updated_at": time.time(),
+        **fields,
+    }
+    columns = ", ".join(values)
+    placeholders = ", ".join("?" for _ in values)
+    updates = ", ".join(f"{column} = excluded.{column}" for column in values if column != "guid")
+    STATE_DB.execute(
+        f"INSERT INTO entries ({columns}) VALUES ({placeholders}) ON CONFLICT (guid) DO UPDATE SET {updates}",
+        tuple(values.values()),
+    )
+
+
+# 记录条目处理失败，重试次数加一，返回累计失败次数
+def record_failure(entry, error):
+    record = STATE_DB.execute("SELECT retries FROM entries WHERE guid = ?", (entry['guid'],)).fetchone()
+    retries = (record["retries"] if record else 0) + 1
+    record_entry(entry, ENTRY_FAILED, retries=retries, error=str(error))
+    return retries
+
+
+# 失败次数未超过上限、需要在本轮重试的条目
+def load_retry_entries():
+    rows = STATE_DB.execute(
+        "SELECT data, retries FROM entries WHERE state = ? AND retries < ? AND data IS NOT NULL",
+        (ENTRY_FAILED, MAX_RETRY_CYCLES),
+    ).fetchall()
+    return [json.loads(row["data"]) for row in rows]
+
+
+# 已提交、等待完成的离线任务（由状态轮询跟踪）
+def load_tracked_entries():
+    return STATE_DB.execute(
+        "SELECT * FROM entries WHERE state = ? AND task_id IS NOT NULL AND data IS NOT NULL",
+        (ENTRY_TASK_SUBMITTED,),
+    ).fetchall()
+
+
+# 保存单个账号的客户端状态
+def store_client_state(username, last_refresh_time, client_token):
+    STATE_DB.execute(
+        "INSERT INTO clients (username, last_refresh_time, client_token) VALUES (?, ?, ?) "
+        "ON CONFLICT (username) DO UPDATE SET last_refresh_time = excluded.last_refresh_time, client_token = excluded.client_token",
+        (username, last_refresh_time, json.dumps(client_token, ensure_ascii=False)),
+    )
+
+
+# 保存单个订阅的 RSS 轮询状态
+def store_feed_state(url, state):
+    STATE_DB.execute(
+        "INSERT OR REPLACE INTO feeds (url, etag, last_modified, watermark, seen, cadence) VALUES (?, ?, ?, ?, ?, ?)",
+        (url, state.get('etag'), state.get('last_modified'), state.get('watermark'), json.dumps(state.get('seen', []), ensure_ascii=False),
+         json.dumps(state.get('cadence') or {})),
+    )
+
+
+# 打开 lease 存储的专用连接：配置了 lease_db 时使用共享的 SQLite 文件（不开启 WAL，网络文件系统不支持共享内存），
+# 否则连接状态数据库文件；并清理保留期已过的已提交认领
+def open_lease_db():
+    global LEASE_DB
+    path = LEASE_DB_FILE or STATE_DB.execute("PRAGMA database_list").fetchone()["file"] or ":memory:"
+    LEASE_DB = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=LEASE_BUSY_TIMEOUT)
+    LEASE_DB.row_factory = sqlite3.Row
+    LEASE_DB.executescript(CLAIMS_SCHEMA)
+    LEASE_DB.execute("DELETE FROM claims WHERE done = 1 AND updated_at < ?", (time.time() - LEASE_DONE_RETENTION,))
+
+
+def lease_store():
+    return LEASE_DB or STATE_DB
+
+
+# 在工作线程中执行 lease 操作：lease 存储被其他实例锁定时最多等待 LEASE_BUSY_TIMEOUT 秒，不能阻塞事件循环
+# 同一连接上同时只执行一个操作
+async def lease_call(func, *args, **kwargs):
+    def run():
+        with LEASE_LOCK:
+            return func(*args, **kwargs)
+    return await asyncio.to_thread(run)
+
+
+# 在同一个事务中认领一批 key：未被认领、由本实例持有或租期已过（原实例崩溃）时取得 lease
+# limit 为本次最多取得的 lease 数（0 表示不限），达到上限后的 key 不再认领
+# 在工作线程中执行，不记录日志和指标；返回 ({key: LEASE_CLAIMED / LEASE_HELD / LEASE_DONE}, [(被接管的 key, 原实例)])，未认领的 key 不在其中
+def claim_leases(keys, limit=0):
+    db = lease_store()
+    now = time.time()
+    statuses = {}
+    takeovers = []
+    claimed = 0
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        for key in keys:
+            if key in statuses:
+                continue
+            if limit and claimed >= limit:
+                break
+            row = db.execute("SELECT owner, expires_at, done FROM claims WHERE key = ?", (key,)).fetchone()
+            if row and row["done"]:
+                statuses[key] = LEASE_DONE
+                continue
+            if row and row["owner"] != INSTANCE_ID and row["expires_at"] > now:
+                statuses[key] = LEASE_HELD
+                continue
+            if row and row["owner"] != INSTANCE_ID:
+                takeovers.append((key, row["owner"]))
+            db.execute(
+                "INSERT INTO claims (key, owner, expires_at, done, updated_at) VALUES (?, ?, ?, 0, ?) "
+                "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at, updated_at = excluded.updated_at",
+                (key, INSTANCE_ID, now + LEASE_TTL, now),
+            )
+            statuses[key] = LEASE_CLAIMED
+            claimed += 1
+    return statuses, takeovers
+
+
+# 在工作线程中认领一批 key，回到事件循环后记录接管日志和认领指标；返回 {key: 认领结果}
+async def claim_keys(keys, limit=0):
+    statuses, takeovers = await lease_call(claim_leases, keys, limit)
+    for key, owner in takeovers:
+        console.log(f"[yellow]接管已过期的认领: {key} (原实例 {owner})[/yellow]")
+        LEASE_CLAIMS.inc(result="takeover")
+    for status in statuses.values():
+        LEASE_CLAIMS.inc(result=status)
+    return statuses
+
+
+# 本实例是否仍持有 key 的 lease（续租不及时时可能已被其他实例接管）
+def holds_lease(key):
+    row = lease_store().execute("SELECT owner, done FROM claims WHERE key = ?", (key,)).fetchone()
+    return row is not None and row["owner"] == INSTANCE_ID and not row["done"]
+
+
+# 结束一批认领：已提交（或云端已存在）时标记为完成并保留 LEASE_DONE_RETENTION，否则释放给其他实例
+def release_leases(keys, done=False):
+    if done:
+        now = time.time()
+        lease_store().executemany("UPDATE claims SET done = 1, updated_at = ? WHERE key = ? AND owner = ?", [(now, key, INSTANCE_ID) for key in keys])
+    else:
+        lease_store().executemany("DELETE FROM claims WHERE key = ? AND owner = ? AND done = 0", [(key, INSTANCE_ID) for key in keys])
+
+
+# 续租本实例持有的全部未完成认领
+def renew_leases():
+    lease_store().execute("UPDATE claims SET expires_at = ? WHERE owner = ? AND done = 0", (time.time() + LEASE_TTL, INSTANCE_ID))
+
+
+# 退出时释放本实例持有的全部未完成认领，其他实例不必等待租期结束
+def release_all_leases():
+    try:
+        with LEASE_LOCK:
+            lease_store().execute("DELETE FROM claims WHERE owner = ? AND done = 0", (INSTANCE_ID,))
+    except Exception as e:
+        console.log(f"[yellow]释放认领失败: {e}[/yellow]")
+
+
+# 记录因其他实例正在处理或超过认领上限而推迟的条目（不改动条目本身的状态），下一轮重新认领
+# instance 只记录由哪个实例推迟；实例标识含进程号，重启或单次运行后会变化，因此读取时不按实例过滤
+def defer_entries(entries):
+    now = time.time()
+    STATE_DB.executemany(
+        "INSERT OR REPLACE INTO deferred (instance, guid, data, updated_at) VALUES (?, ?, ?, ?)",
+        [(INSTANCE_ID, entry['guid'], json.dumps(entry, ensure_ascii=False), now) for entry in entries],
+    )
+
+
+# 所有推迟、尚未认领的条目（包括已退出的实例推迟的），本轮重新认领
+def load_deferred_entries():
+    rows = STATE_DB.execute("SELECT data FROM deferred GROUP BY guid").fetchall()
+    return [json.loads(row["data"]) for row in rows]
+
+
+# 条目已认领或已由其他实例提交，不再推迟
+def clear_deferred(entries):
+    STATE_DB.executemany("DELETE FROM deferred WHERE guid = ?", [(entry['guid'],) for entry in entries])
+
+
+# 将订阅中的账号引用（下标或用户名）解析为账号下标，未指定或为 "auto" 时返回 None（自动分配）
+def resolve_account(ref):
+    if ref is None or ref == "auto":
+        return None
+    if isinstance(ref, int) and 0 <= ref < len(USER):
+        return ref
+    if ref in USER:
+        return USER.index(ref)
+    console.log(f"[yellow]订阅中的账号 {ref} 不存在，将自动分配账号。[/yellow]")
+    return None
+
+
+# 配置项可写为单个字符串或列表
+def as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+# 创建订阅项，订阅自己的包含 / 排除规则与全局规则合并后预编译
+def make_feed(url, account=None, path=None, include=(), exclude=()):
+    return {
+        "url": url, "account": account, "path": path,
+        "include": list(include), "exclude": list(exclude),
+        "filter": TitleFilter(FILTER_INCLUDE + list(include), FILTER_EXCLUDE + list(exclude)),
+    }
+
+
+# 根据配置内容更新全局变量，兼容旧版单账号格式 (username / password / path / rss)
+def apply_config(config):
+    global ON_COMPLETE_COMMAND, DOWNLOAD_DIR, DOWNLOAD_SEGMENTS, DOWNLOAD_BANDWIDTH_LIMIT
+    global METRICS_HOST, METRICS_PORT, CYCLE_SUMMARY
+    global FILTER_INCLUDE, FILTER_EXCLUDE, BEST_RELEASE_ONLY, PREFER_RESOLUTION, PREFER_LANGUAGE
+    global FEED_MIN_INTERVAL, FEED_MAX_INTERVAL
+    global LEASE_DB_FILE, LEASE_TTL, CLAIM_BATCH, INSTANCE_ID, SAVE_TORRENT_FILES
+    accounts = config.get("accounts") or [{
+        "username": config.get("username"),
+        "password": config.get("password"),
+        "path": config.get("path"),
+    }]
+    ON_COMPLETE_COMMAND = config.get("on_complete")
+    DOWNLOAD_DIR = config.get("download_dir")
+    SAVE_TORRENT_FILES = bool(config.get("save_torrents", SAVE_TORRENT_FILES))
+    DOWNLOAD_SEGMENTS = int(config.get("download_segments", DOWNLOAD_SEGMENTS))
+    DOWNLOAD_BANDWIDTH_LIMIT = int(config.get("download_bandwidth", DOWNLOAD_BANDWIDTH_LIMIT))
+    METRICS_HOST = config.get("metrics_host", METRICS_HOST)
+    METRICS_PORT = config.get("metrics_port", METRICS_PORT)
+    CYCLE_SUMMARY = bool(config.get("cycle_summary", CYCLE_SUMMARY))
+    FEED_MIN_INTERVAL = int(config.get("rss_min_interval", FEED_MIN_INTERVAL))
+    FEED_MAX_INTERVAL = int(config.get("rss_max_interval", FEED_MAX_INTERVAL))
+    LEASE_DB_FILE = config.get("lease_db")
+    LEASE_TTL = int(config.get("lease_ttl", LEASE_TTL))
+    CLAIM_BATCH = int(config.get("claim_batch", CLAIM_BATCH))
+    INSTANCE_ID = config.get("instance_id") or INSTANCE_ID
+    filters = config.get("filters") or {}
+    FILTER_INCLUDE = as_list(filters.get("include"))
+    FILTER_EXCLUDE = as_list(filters.get("exclude"))
+    BEST_RELEASE_ONLY = bool(config.get("best_release", BEST_RELEASE_ONLY))
+    PREFER_RESOLUTION = [int(value) for value in as_list(config.get("prefer_resolution"))]
+    PREFER_LANGUAGE = [str(value).lower() for value in as_list(config.get("prefer_language"))]
+    USER[:] = [account.get("username") or "" for account in accounts]
+    PASSWORD[:] = [account.get("password") or "" for account in accounts]
+    PATH[:] = [account.get("path") or "" for account in accounts]
+
+    feeds = config.get("feeds")
+    if feeds is None:
+        feeds = [{"url": config.get("rss")}] if config.get("rss") else []
+    FEEDS.clear()
+    for feed in feeds:
+        if isinstance(feed, str):
+            feed = {"url": feed}
+        account = resolve_account(feed.get("account"))
+        path = feed.get("path")
+        if path and account is None:
+            # 文件夹 ID 只属于某一个账号，自动分配账号的订阅只能使用账号默认路径
+            console.log(f"[yellow]订阅 {feed.get('url')} 未指定账号，忽略其保存路径 {path}。[/yellow]")
+            path = None
+        FEEDS.append(make_feed(feed.get("url") or "", account, path, as_list(feed.get("include")), as_list(feed.get("exclude"))))
+
+
+# 配置是否完整：每个账号都有用户名、密码和保存路径，且至少有一个 RSS 订阅
+def config_is_complete():
+    return all(USER) and all(PASSWORD) and all(PATH) and bool(FEEDS) and all(feed["url"] for feed in FEEDS)
 
 
-# 加载基本配置文件，并更新全局变量
+# 用环境变量补全缺失的配置项（PIKPAK_USERNAME / PIKPAK_PASSWORD / PIKPAK_PATH 对应第一个账号，PIKPAK_RSS 可为空白分隔的多个链接）
+# 每次启动都会重新读取，环境变量优先于上次交互输入的配置，且不会被保存
+def apply_env_config():
+    if not USER:
+        USER.append("")
+        PASSWORD.append("")
+        PATH.append("")
+    USER[0] = USER[0] or os.environ.get("PIKPAK_USERNAME", "")
+    PASSWORD[0] = PASSWORD[0] or os.environ.get("PIKPAK_PASSWORD", "")
+    PATH[0] = PATH[0] or os.environ.get("PIKPAK_PATH", "")
+    FEEDS[:] = [feed for feed in FEEDS if feed["url"]]
+    if not FEEDS:
+        FEEDS.extend(make_feed(url) for url in os.environ.get("PIKPAK_RSS", "").split())
+
+
+# 用上次交互输入的配置补全仍缺失的配置项
+def apply_prompted_config(prompted):
+    for i, account in enumerate((prompted.get("accounts") or [])[:len(USER)]):
+        USER[i] = USER[i] or account.get("username") or ""
+        PASSWORD[i] = PASSWORD[i] or account.get("password") or ""
+        PATH[i] = PATH[i] or account.get("path") or ""
+    if not FEEDS:
+        FEEDS.extend(make_feed(url) for url in prompted.get("feeds") or [] if url)
+
+
+# 交互式补全缺失的配置项，返回用户实际输入的值；无终端模式或单次运行时直接退出
+def prompt_missing_config():
+    if HEADLESS or ONE_SHOT:
+        console.log("[red]配置不完整：无终端模式或单次运行时请通过 config.json 或环境变量 PIKPAK_USERNAME / PIKPAK_PASSWORD / PIKPAK_PATH / PIKPAK_RSS 提供配置。[/red]")
+        sys.exit(EXIT_CONFIG_ERROR)
+    prompted = {"accounts": [{} for _ in USER], "feeds": []}
+    for i in range(len(USER)):
+        label = f"账号 {i + 1} " if len(USER) > 1 else ""
+        account = prompted["accounts"][i]
+        if not USER[i]:
+            USER[i] = account["username"] = console.input(f"请输入 PikPak {label}用户名: ")
+        if not PASSWORD[i]:
+            PASSWORD[i] = account["password"] = console.input(f"请输入 PikPak {label}密码: ", password=True)
+        if not PATH[i]:
+            PATH[i] = account["path"] = console.input(f"请输入 PikPak {label}保存路径 (文件夹 ID): ")
+    FEEDS[:] = [feed for feed in FEEDS if feed["url"]]
+    if not FEEDS:
+        url = console.input("请输入 RSS 订阅链接: ")
+        FEEDS.append(make_feed(url))
+        prompted["feeds"].append(url)
+    return prompted
+
+
+# 加载基本配置，并更新全局变量
+# 优先级：config.json > 环境变量 > 上次交互输入的配置；config.json 由用户维护，程序不会改写
 def load_config():
-    config_complete = False
+    apply_config({})
     if os.path.exists(CONFIG_FILE):
         try:
             with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-                config = json.load(f)
-            # Check if all required keys exist and are not empty
-            if config.get("username") and config.get("password") and config.get("path") and config.get("rss"):
-                USER[0] = config.get("username")
-                PASSWORD[0] = config.get("password")
-                PATH[0] = config.get("path")
-                RSS[0] = config.get("rss")
-                console.log("[green]配置文件加载成功！[/green]")
-                config_complete = True
-            else:
-                console.log("[yellow]配置文件不完整，需要补充信息。[/yellow]")
-                # Load existing values or prompt if missing
-                USER[0] = config.get("username") or console.input("请输入 PikPak 用户名: ")
-                PASSWORD[0] = config.get("password") or console.input("请输入 PikPak 密码: ", password=True)
-                PATH[0] = config.get("path") or console.input("请输入 PikPak 保存路径 (文件夹 ID): ")
-                RSS[0] = config.get("rss") or console.input("请输入 RSS 订阅链接: ")
-                update_config() # Save the completed config
-                config_complete = True # Mark as complete after getting input
+                apply_config(json.load(f))
         except Exception as e:
-            console.log(f"[red]加载配置文件失败: {str(e)}，将提示输入。[/red]")
-            # Fall through to prompt if loading fails
-    
-    if not config_complete: # Prompt if file doesn't exist or loading failed/incomplete
-        console.log("[yellow]配置文件不存在或加载失败，请手动输入配置信息。[/yellow]")
-        USER[0] = console.input("请输入 PikPak 用户名: ")
-        PASSWORD[0] = console.input("请输入 PikPak 密码: ", password=True)
-        PATH[0] = console.input("请输入 PikPak 保存路径 (文件夹 ID): ")
-        RSS[0] = console.input("请输入 RSS 订阅链接: ")
-        update_config() # Save the newly created config
-
-
-# 如果存在保存的客户端状态，则优先从 CLIENT_STATE_FILE 中加载token
+            console.log(f"[red]加载配置文件失败: {str(e)}[/red]")
+            apply_config({})
+    apply_env_config()
+    apply_prompted_config(kv_get("prompted_config", {}))
+    # 旧版本把完整配置（包括来自环境变量的密码）保存在 "config" 中，不再使用
+    STATE_DB.execute("DELETE FROM kv WHERE key = 'config'")
+    if config_is_complete():
+        console.log(f"[green]配置加载成功！[/green] ({len(USER)} 个账号, {len(FEEDS)} 个订阅)")
+        return
+
+    console.log("[yellow]配置不完整，请手动输入缺少的配置信息。[/yellow]")
+    update_config(prompt_missing_config())
+
+
+# 读取旧版 CLIENT_STATE_FILE 中保存的各账号状态（用户名 -> 状态），兼容单账号格式
+def load_client_states():
+    with open(CLIENT_STATE_FILE, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if "clients" in config:
+        return config["clients"]
+    client_token = config.get("client_token", {})
+    if not client_token:
+        return {}
+    return {client_token.get("username"): {
+        "last_refresh_time": config.get("last_refresh_time", 0),
+        "client_token": client_token,
+    }}
+
+
+# 如果存在保存的客户端状态，则优先从状态数据库中加载token
 # 否则根据用户名和密码新建客户端对象
-# 此外，检验客户端是否是当前用户的，若不是则重新登录
+# 状态按用户名保存，因此不会把其他账号的 token 用于当前账号
 def init_clients():
-    global last_refresh_time
-    client = None
-    if os.path.exists(CLIENT_STATE_FILE):
+    states = {}
+    try:
+        for row in STATE_DB.execute("SELECT username, last_refresh_time, client_token FROM clients"):
+            states[row["username"]] = {
+                "last_refresh_time": row["last_refresh_time"],
+                "client_token": json.loads(row["client_token"]),
+            }
+    except Exception as e:
+        console.log(f"[yellow]加载客户端状态失败: {str(e)}，将尝试使用配置中的用户名/密码创建客户端。[/yellow]")
+    if not states:
+        console.log("[yellow]没有保存的客户端状态，将尝试使用配置中的用户名/密码创建新客户端。[/yellow]")
+
+    PIKPAK_CLIENTS[:] = [create_client(i, states.get(USER[i])) for i in range(len(USER))]
+    for i, client in enumerate(PIKPAK_CLIENTS):
+        if client:
+            install_token_hook(i, client)
+            install_request_hook(client)
+    LAST_REFRESH_TIME[:] = [(states.get(USER[i]) or {}).get("last_refresh_time", 0) for i in range(len(USER))]
+    TASK_INDEXES[:] = [None] * len(USER)
+
+
+# 为单个账号创建客户端对象
+def create_client(account_index, state):
+    from pikpakapi import PikPakApi
+    client_token = (state or {}).get("client_token")
+    if client_token:
         try:
-            with open(CLIENT_STATE_FILE, "r", encoding="utf-8") as f:
-                config = json.load(f)
-            last_refresh_time = config.get("last_refresh_time", 0)
-            client_token = config.get("client_token", {})
-            if client_token and client_token.get("username") == USER[0]:
-                client = PikPakApi.from_dict(client_token)
-                console.log("[green]成功从客户端状态文件加载登录状态！[/green]")
-            else:
-                console.log("[yellow]客户端状态文件中的用户名与配置不符，将重新创建客户端。[/yellow]")
-                client = PikPakApi(username=USER[0], password=PASSWORD[0])
+            client = PikPakApi.from_dict(client_token)
+            console.log(f"[green]账号 [cyan]{USER[account_index]}[/cyan] 成功从客户端状态文件加载登录状态！[/green]")
+            return client
         except Exception as e:
-            console.log(f"[yellow]加载客户端状态失败: {str(e)}，将尝试使用配置中的用户名/密码创建客户端。[/yellow]")
-            if not USER[0] or not PASSWORD[0]:
-                console.log("[red]配置中缺少用户名或密码，无法创建客户端。请检查 config.json 或环境变量。[/red]")
-                client = None # Set client to None if credentials missing
-            else:
-                try:
-                    client = PikPakApi(username=USER[0], password=PASSWORD[0])
-                except Exception as api_e:
-                    console.log(f"[red]使用配置创建客户端失败: {api_e}[/red]")
-                    client = None
-    else:
-        console.log("[yellow]客户端状态文件不存在，将尝试使用配置中的用户名/密码创建新客户端。[/yellow]")
-        if not USER[0] or not PASSWORD[0]:
-            console.log("[red]配置中缺少用户名或密码，无法创建客户端。请检查 config.json 或环境变量。[/red]")
-            client = None # Set client to None if credentials missing
-        else:
-            try:
-                client = PikPakApi(username=USER[0], password=PASSWORD[0])
-            except Exception as api_e:
-                console.log(f"[red]使用配置创建客户端失败: {api_e}[/red]")
-                client = None
-
-    PIKPAK_CLIENTS[0] = client
+            console.log(f"[yellow]账号 {USER[account_index]} 加载客户端状态失败: {str(e)}，将使用用户名/密码创建客户端。[/yellow]")
+    if not USER[account_index] or not PASSWORD[account_index]:
+        console.log(f"[red]账号 {account_index} 配置中缺少用户名或密码，无法创建客户端。请检查 config.json 或环境变量。[/red]")
+        return None # Set client to None if credentials missing
+    try:
+        return PikPakApi(username=USER[account_index], password=PASSWORD[account_index])
+    except Exception as api_e:
+        console.log(f"[red]账号 {USER[account_index]} 使用配置创建客户端失败: {api_e}[/red]")
+        return None
 
 
-# 保存基本配置到 CONFIG_FILE
-def update_config():
-    config = {
-        "username": USER[0],
-        "password": PASSWORD[0],
-        "path": PATH[0],
-        "rss": RSS[0],
-    }
+# 保存用户交互输入的配置项到状态数据库（与上次输入的值合并），来自 config.json 和环境变量的值不会保存
+def update_config(prompted):
+    config = kv_get("prompted_config", {})
+    accounts = config.setdefault("accounts", [])
+    for i, account in enumerate(prompted.get("accounts", [])):
+        if i >= len(accounts):
+            accounts.append({})
+        accounts[i].update(account)
+    if prompted.get("feeds"):
+        config["feeds"] = prompted["feeds"]
     try:
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
-        # console.log("[green]配置文件更新成功！[/green]") # Avoid logging this every time
+        kv_set("prompted_config", config)
     except Exception as e:
-        console.log(f"[red]配置文件更新失败: {str(e)}[/red]")
+        console.log(f"[red]配置保存失败: {str(e)}[/red]")
 
 
-# 保存token到 CLIENT_STATE_FILE
+# 保存所有账号的 token 到状态数据库（单个事务）
 def save_client():
-    if not PIKPAK_CLIENTS[0]: # Avoid saving if client initialization failed
+    if not any(PIKPAK_CLIENTS): # Avoid saving if client initialization failed
         console.log("[yellow]客户端未初始化，跳过保存状态。[/yellow]")
         return
-    config = {
-        "last_refresh_time": last_refresh_time,
-        "client_token": PIKPAK_CLIENTS[0].to_dict(),
-    }
     try:
-        with open(CLIENT_STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
+        with STATE_DB:
+            STATE_DB.execute("BEGIN")
+            for i, client in enumerate(PIKPAK_CLIENTS):
+                if client:
+                    store_client_state(USER[i], LAST_REFRESH_TIME[i], client.to_dict())
         console.log("[green]客户端状态保存成功！[/green]")
     except Exception as e:
         console.log(f"[red]客户端状态保存失败: {str(e)}[/red]")
 
 
-# 1. 先尝试调用 file_list() 检查 token 是否有效；
-# 2. 若调用失败，则重新使用用户名密码登录；
-async def login(account_index):
-    client = PIKPAK_CLIENTS[account_index]
-    if not client: # Check if client exists
-        console.log(f"[red]账号 {account_index} 客户端未初始化，无法登录。[/red]")
+# 计数器指标，labels 为标签名到值的映射
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}  # 排序后的标签元组 -> 值
+        METRICS[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+# 直方图指标，按累计桶计数
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # 排序后的标签元组 -> [各桶计数, 总和, 次数]
+        METRICS[name] = self
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", key + (("le", str(bound)),), bucket_count
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+
+# 仪表指标，可增可减；指定 func 时在抓取时调用 func 取值，func 返回数值或 {标签元组: 值}
+class Gauge(Counter):
+    type = "gauge"
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self.func = func
+
+    def samples(self):
+        if self.func is None:
+            yield from super().samples()
+            return
+        value = self.func()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield self.name, key, item
+        else:
+            yield self.name, (), value
+
+
+# 转义标签值中的反斜杠、双引号和换行
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# 渲染 Prometheus 文本格式
+def render_metrics():
+    lines = []
+    for metric in METRICS.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            label_text = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# 信号量上等待的协程数（队列深度）
+def semaphore_waiters(semaphore):
+    return semaphore.waiting if semaphore is not None else 0
+
+
+# 记录等待数的信号量，供队列深度指标使用（不读取 asyncio.Semaphore 的私有属性）
+class CountingSemaphore(asyncio.Semaphore):
+    def __init__(self, value=1):
+        super().__init__(value)
+        self.waiting = 0
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            return await super().acquire()
+        finally:
+            self.waiting -= 1
+
+
+STAGE_DURATION = Histogram("pikpak_stage_duration_seconds", "各阶段耗时（秒）")
+STAGE_IN_PROGRESS = Gauge("pikpak_stage_in_progress", "各阶段正在执行的数量")
+API_CALLS = Counter("pikpak_api_calls_total", "PikPak API 调用次数")
+RETRIES = Counter("pikpak_retries_total", "临时错误的重试次数")
+DEDUP_RESULTS = Counter("pikpak_dedup_total", "查重结果（hit 为已存在而跳过，miss 为需要提交）")
+ERRORS = Counter("pikpak_errors_total", "各阶段的错误数（按异常类型）")
+LEASE_CLAIMS = Counter("pikpak_lease_claims_total", "条目认领结果（claimed / held / done / takeover）")
+Gauge("pikpak_queue_depth", "等待并发许可或处理中的数量", lambda: {
+    (("queue", "torrent_semaphore"),): semaphore_waiters(TORRENT_SEMAPHORE),
+    (("queue", "api_semaphore"),): semaphore_waiters(API_SEMAPHORE),
+    (("queue", "download_semaphore"),): semaphore_waiters(DOWNLOAD_SEMAPHORE),
+    (("queue", "folder_lookups"),): len(_folder_lookups),
+    (("queue", "downloads"),): len(_download_jobs),
+})
+Gauge("pikpak_entries", "状态数据库中各状态的条目数", lambda: {
+    (("state", row["state"]),): row["count"]
+    for row in STATE_DB.execute("SELECT state, COUNT(*) AS count FROM entries GROUP BY state")
+} if STATE_DB else {})
+
+
+# 记录一次错误
+def count_error(stage, error):
+    ERRORS.inc(stage=stage, type=type(error).__name__)
+
+
+# 为异步阶段函数记录耗时、并发数和抛出的异常，并计入本轮耗时汇总
+def instrument(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            STAGE_IN_PROGRESS.inc(stage=stage)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                count_error(stage, e)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                STAGE_IN_PROGRESS.inc(-1, stage=stage)
+                STAGE_DURATION.observe(elapsed, stage=stage)
+                timing = _cycle_timings.setdefault(stage, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+        return wrapper
+    return decorator
+
+
+# 输出本轮各阶段耗时汇总
+def log_cycle_summary(elapsed):
+    stages = {stage: {"count": count, "total": round(total, 3), "max": round(longest, 3)}
+              for stage, (count, total, longest) in _cycle_timings.items()}
+    if HEADLESS:
+        emit_event("cycle_summary", elapsed=round(elapsed, 3), stages=stages)
         return
+    summary = "; ".join(f"{stage} {item['count']} 次 共 {item['total']:.2f}s (最长 {item['max']:.2f}s)" for stage, item in stages.items())
+    console.log(f"本轮耗时 {elapsed:.2f}s: {summary or '无'}")
+
+
+# 本地 HTTP 服务：按 HTTP_ROUTES 分发请求，每个连接处理一个请求
+async def handle_http_request(reader, writer):
     try:
-        # 尝试用 token 调用 file_list() 检查 token 是否有效
-        await client.file_list(parent_id=PATH[account_index])
-        console.log(f"账号 [cyan]{USER[account_index]}[/cyan] Token 有效")
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b"\r\n", b"\n", b""):
+            pass
+        method, target = request_line.decode("latin-1").split()[:2]
+        route = HTTP_ROUTES.get((method, urllib.parse.urlsplit(target).path))
+        status, content_type, body = await route(target) if route else (404, "text/plain", "not found\n")
+        body = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
     except Exception as e:
-        console.log(f"[yellow]使用 token 读取文件列表失败: {str(e)}，将重新登录。[/yellow]")
+        console.log(f"[yellow]处理 HTTP 请求失败: {e}[/yellow]")
+    finally:
+        writer.close()
+
+
+async def metrics_route(target):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+
+
+HTTP_ROUTES[("GET", "/metrics")] = metrics_route
+
+
+# 启动本地 HTTP 服务（未配置端口时不启动）
+async def start_http_server():
+    if METRICS_PORT is None:
+        return None
+    server = await asyncio.start_server(handle_http_request, METRICS_HOST, METRICS_PORT)
+    console.log(f"监控服务已启动: [link=http://{METRICS_HOST}:{METRICS_PORT}/metrics]http://{METRICS_HOST}:{METRICS_PORT}/metrics[/link]")
+    return server
+
+
+# 读取 access token（JWT）中的过期时间，无法解析时返回 None
+def token_expiry(client):
+    try:
+        payload = client.access_token.split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+    except Exception:
+        return None
+
+
+# token 是否需要刷新：按 JWT 的过期时间提前 TOKEN_REFRESH_MARGIN 秒；无法解析时退回按固定间隔刷新
+def token_needs_refresh(account_index):
+    client = PIKPAK_CLIENTS[account_index]
+    if not getattr(client, 'access_token', None):
+        return True
+    expiry = token_expiry(client)
+    if expiry is None:
+        return time.time() - LAST_REFRESH_TIME[account_index] >= INTERVAL_TIME_REFRESH
+    return expiry - time.time() <= TOKEN_REFRESH_MARGIN
+
+
+# 刷新 token，失败时重新登录；同一账号的并发调用共享同一次刷新，返回是否成功
+async def renew_token(account_index):
+    renewal = _token_renewals.get(account_index)
+    if renewal is None:
+        renewal = asyncio.ensure_future(refresh_or_login(account_index))
+        _token_renewals[account_index] = renewal
+        renewal.add_done_callback(lambda _: _token_renewals.pop(account_index, None))
+    return await asyncio.shield(renewal)
+
+
+async def refresh_or_login(account_index):
+    from pikpakapi import PikPakApi
+    client = PIKPAK_CLIENTS[account_index]
+    if getattr(client, 'refresh_token', None):
+        console.log(f"账号 [cyan]{USER[account_index]}[/cyan] 尝试刷新 token...")
         try:
-            await client.login()
-            console.log(f"账号 [cyan]{USER[account_index]}[/cyan] 登录成功！")
-            save_client() # Save client state after successful login
+            # 直接调用类方法，绕过 install_token_hook 安装的实例钩子
+            await PikPakApi.refresh_access_token(client)
+            console.log(f"[green]账号 {USER[account_index]} token 刷新成功！[/green]")
+            LAST_REFRESH_TIME[account_index] = time.time()
+            save_client()
+            return True
         except Exception as e:
-            console.log(f"[red]账号 {USER[account_index]} 登录失败: {str(e)}[/red]")
-            PIKPAK_CLIENTS[account_index] = None # Mark client as invalid
+            count_error("refresh_token", e)
+            console.log(f"[red]账号 {USER[account_index]} token 刷新失败: {str(e)}[/red]")
+    try:
+        console.log(f"[yellow]账号 {USER[account_index]} 尝试重新登录...[/yellow]")
+        await client.login()
+        console.log(f"账号 [cyan]{USER[account_index]}[/cyan] 登录成功！")
+        LAST_REFRESH_TIME[account_index] = time.time()
+        save_client()
+        return True
+    except Exception as e:
+        count_error("login", e)
+        console.log(f"[red]账号 {USER[account_index]} 登录失败: {str(e)}[/red]")
+        PIKPAK_CLIENTS[account_index] = None # Mark client as invalid
+        return False
+
+
+# pikpakapi 在请求返回 token 失效时会自行调用 refresh_access_token 并重试该请求；
+# 把它替换为共享的 renew_token，避免并发请求各自刷新
+def install_token_hook(account_index, client):
+    from pikpakapi.PikpakException import PikpakException
+
+    async def refresh_access_token():
+        if asyncio.current_task() is _token_renewals.get(account_index):
+            raise PikpakException("token 刷新请求本身返回 token 失效")
+        if not await renew_token(account_index):
+            raise PikpakException("token 刷新和重新登录均失败")
+    client.refresh_access_token = refresh_access_token
+
+
+# 重试统一由 api_call 按请求类型决定：关闭 pikpakapi 自带的重试（每次最多 3 次、3/6/12 秒退避），
+# 并把传输层错误原样抛出（pikpakapi 会直接重新抛出 PikpakException），保留原始异常供 is_transient_error 判断
+def install_request_hook(client):
+    import httpx
+    from pikpakapi.PikpakException import PikpakException
+
+    send_request = client._send_request
+    async def send_request_once(*args, **kwargs):
+        try:
+            return await send_request(*args, **kwargs)
+        except httpx.HTTPError as e:
+            raise PikpakException(f"{type(e).__name__}: {e}") from e
+    client._send_request = send_request_once
+    client.max_retries = 1
+    client.initial_backoff = 0
+
+
+# 判断错误是否表示 token 失效
+def is_auth_error(error):
+    import httpx
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 401
+    message = str(error).lower()
+    return any(keyword in message for keyword in ("401", "unauthenticated", "unauthorized", "token is expired", "invalid token", "token refreshed"))
+
+
+# 定时检查 token，在过期前提前刷新
+@instrument("refresh_token")
+async def auto_refresh_token(account_index):
+    if PIKPAK_CLIENTS[account_index] and token_needs_refresh(account_index):
+        await renew_token(account_index)
+
+
+# 获取进程共享的 httpx.AsyncClient，首次使用时创建；安装了 h2 时启用 HTTP/2
+def get_http_client():
+    import httpx
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None or HTTP_CLIENT.is_closed:
+        HTTP_CLIENT = httpx.AsyncClient(
+            follow_redirects=True,
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(**HTTP_TIMEOUTS),
+        )
+    return HTTP_CLIENT
+
+
+# 获取本地下载专用的客户端：只用 HTTP/1.1，每个分段占用独立的连接，连接数按同时下载的文件数和分段数确定
+def get_download_client():
+    import httpx
+    global DOWNLOAD_CLIENT
+    if DOWNLOAD_CLIENT is None or DOWNLOAD_CLIENT.is_closed:
+        connections = DOWNLOAD_CONCURRENCY * max(1, DOWNLOAD_SEGMENTS)
+        DOWNLOAD_CLIENT = httpx.AsyncClient(
+            follow_redirects=True,
+            http2=False,
+            limits=httpx.Limits(
+                max_connections=connections,
+                max_keepalive_connections=connections,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(**HTTP_TIMEOUTS),
+        )
+    return DOWNLOAD_CLIENT
+
+
+# 关闭共享的 HTTP 客户端和下载客户端并释放连接
+async def close_http_client():
+    global HTTP_CLIENT, DOWNLOAD_CLIENT
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+    if DOWNLOAD_CLIENT is not None:
+        await DOWNLOAD_CLIENT.aclose()
+        DOWNLOAD_CLIENT = None
+
+
+# 通过共享客户端发起 GET 请求，支持条件请求（ETag / Last-Modified），304 视为正常响应
+async def http_get(url, etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = await get_http_client().get(url, headers=headers)
+    if response.status_code != 304:
+        response.raise_for_status()
+    return response
+
+
+# 令牌桶限速器：按 rate 每秒补充令牌，最多积累 capacity 个
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+# 为当前事件循环创建并发限制和限速器
+def init_scheduler():
+    global TORRENT_SEMAPHORE, API_SEMAPHORE, API_RATE_LIMITER, TRACKER_WAKEUP, DOWNLOAD_SEMAPHORE, DOWNLOAD_RATE_LIMITER
+    global FEED_TRIGGER
+    TRACKER_WAKEUP = asyncio.Event()
+    FEED_TRIGGER = asyncio.Event()
+    DOWNLOAD_SEMAPHORE = CountingSemaphore(DOWNLOAD_CONCURRENCY)
+    # 令牌桶容量至少为一个块，否则单次 acquire 永远无法满足
+    DOWNLOAD_RATE_LIMITER = TokenBucket(DOWNLOAD_BANDWIDTH_LIMIT, max(DOWNLOAD_BANDWIDTH_LIMIT, DOWNLOAD_CHUNK_SIZE)) if DOWNLOAD_BANDWIDTH_LIMIT > 0 else None
+    TORRENT_SEMAPHORE = CountingSemaphore(TORRENT_CONCURRENCY)
+    API_SEMAPHORE = CountingSemaphore(API_CONCURRENCY)
+    API_RATE_LIMITER = TokenBucket(API_RATE_LIMIT, API_RATE_BURST)
+
+
+# 判断是否为值得重试的临时错误：429 / 限流和连接阶段的错误（请求未送达服务器）总是可以重试；
+# 读超时、5xx 等请求可能已被服务器处理的错误只对只读请求重试（write 为 True 时不重试）
+def is_transient_error(error, write=False):
+    import httpx
+    if isinstance(error.__cause__, httpx.HTTPError):
+        error = error.__cause__
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or (status >= 500 and not write)
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError)):
+        return not write
+    message = str(error).lower()
+    if any(keyword in message for keyword in ("too many", "429", "frequent")):
+        return True
+    return not write and any(keyword in message for keyword in ("timeout", "timed out", "empty json data"))
+
+
+# 写请求失败但服务器可能已经处理（超时、5xx 等），重新提交之前需要先确认结果
+def write_may_have_applied(error):
+    return is_transient_error(error) and not is_transient_error(error, write=True)
+
+
+# 执行 func，遇到临时错误时按带抖动的指数退避重试；write 为 True 时只重试确定未被服务器处理的错误
+async def with_retry(func, *args, write=False, **kwargs):
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_transient_error(e, write):
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            RETRIES.inc(error=type(e).__name__)
+            console.log(f"[yellow]请求失败: {e}，{delay:.1f} 秒后重试 ({attempt + 1}/{RETRY_ATTEMPTS})[/yellow]")
+            await asyncio.sleep(delay)
+
+
+# 通过并发限制和限速器调用 PikPak API，临时错误自动重试（API_WRITE_METHODS 只重试未送达的请求）；
+# token 失效时（刷新共享进行）重试一次
+async def api_call(method, *args, **kwargs):
+    API_CALLS.inc(method=method.__name__)
+    write = method.__name__ in API_WRITE_METHODS
+    async def attempt():
+        async with API_SEMAPHORE:
+            await API_RATE_LIMITER.acquire()
+            return await method(*args, **kwargs)
+    client = getattr(method, '__self__', None)
+    token = getattr(client, 'access_token', None)
+    try:
+        return await with_retry(attempt, write=write)
+    except Exception as e:
+        account_index = next((i for i, c in enumerate(PIKPAK_CLIENTS) if c is client and c), None)
+        if account_index is None or not is_auth_error(e):
+            raise
+        # 其他请求已经刷新过 token 时直接重试
+        if client.access_token == token and not await renew_token(account_index):
+            raise
+        return await with_retry(attempt, write=write)
+
+
+# 解码 data 中从 index 开始的一个 bencode 值，返回 (值, 结束位置)
+def bdecode(data, index=0):
+    token = data[index:index + 1]
+    if token == b'i':
+        end = data.index(b'e', index)
+        return int(data[index + 1:end]), end + 1
+    if token == b'l':
+        index += 1
+        items = []
+        while data[index:index + 1] != b'e':
+            item, index = bdecode(data, index)
+            items.append(item)
+        return items, index + 1
+    if token == b'd':
+        index += 1
+        items = {}
+        while data[index:index + 1] != b'e':
+            key, index = bdecode(data, index)
+            items[key], index = bdecode(data, index)
+        return items, index + 1
+    if token.isdigit():
+        colon = data.index(b':', index)
+        start = colon + 1
+        end = start + int(data[index:colon])
+        if end > len(data):
+            raise ValueError("bencode 字符串长度超出数据范围")
+        return data[start:end], end
+    raise ValueError(f"无效的 bencode 数据 (位置 {index})")
+
+
+# 在内存中解析种子文件，返回 infohash (BTIH，info 字典原始字节的 SHA-1)、名称和 tracker 列表
+def parse_torrent(data):
+    if data[:1] != b'd':
+        raise ValueError("不是有效的种子文件")
+    index = 1
+    meta = {}
+    info_span = None
+    while data[index:index + 1] != b'e':
+        key, index = bdecode(data, index)
+        start = index
+        meta[key], index = bdecode(data, index)
+        if key == b'info':
+            info_span = (start, index)
+    if info_span is None or not isinstance(meta[b'info'], dict):
+        raise ValueError("种子文件缺少 info 字典")
+
+    trackers = []
+    announce_list = [meta.get(b'announce', b'')] + [url for tier in meta.get(b'announce-list', []) for url in tier]
+    for url in announce_list:
+        url = url.decode('utf-8', 'replace') if isinstance(url, bytes) else ''
+        if url and url not in trackers:
+            trackers.append(url)
+    return {
+        'infohash': hashlib.sha1(data[info_span[0]:info_span[1]]).hexdigest(),
+        'name': meta[b'info'].get(b'name', b'').decode('utf-8', 'replace'),
+        'trackers': trackers,
+    }
+
+
+# 从磁力链接中取出 infohash（支持 40 位十六进制和 32 位 base32 两种格式）
+def infohash_from_magnet(url):
+    match = re.search(r"xt=urn:btih:([0-9a-fA-F]{40}|[A-Za-z2-7]{32})", url or "")
+    if not match:
+        return None
+    value = match.group(1)
+    return value.lower() if len(value) == 40 else base64.b32decode(value.upper()).hex()
+
+
+# 根据 infohash 构建磁力链接
+def build_magnet(infohash, name=None, trackers=()):
+    params = [f"xt=urn:btih:{infohash}"]
+    if name:
+        params.append(f"dn={urllib.parse.quote(name)}")
+    params += [f"tr={urllib.parse.quote(tracker, safe='')}" for tracker in list(trackers)[:MAGNET_MAX_TRACKERS]]
+    return "magnet:?" + "&".join(params)
+
+
+# 离线任务索引：按任务名称、文件 hash、来源链接和 infohash 建立哈希索引，查重时 O(1) 命中
+class TaskIndex:
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_hash = {}
+        self.by_url = {}
+        self.by_infohash = {}
+        self.active_ids = set()  # 等待中 / 运行中的任务，用于衡量账号负载
+
+    def __len__(self):
+        return len(self.by_id)
+
+    @property
+    def active(self):
+        return len(self.active_ids)
+
+    def add(self, task):
+        if not task:
             return
+        if task.get('id'):
+            self.by_id[task['id']] = task
+            if task.get('phase', 'PHASE_TYPE_RUNNING') in ACTIVE_TASK_PHASES:
+                self.active_ids.add(task['id'])
+            else:
+                self.active_ids.discard(task['id'])
+        if task.get('name'):
+            self.by_name[task['name']] = task
+        file_hash = (task.get('reference_resource') or {}).get('hash')
+        if file_hash:
+            self.by_hash[file_hash.lower()] = task
+        url = (task.get('params') or {}).get('url')
+        if url:
+            self.by_url[url] = task
+            infohash = infohash_from_magnet(url)
+            if infohash:
+                self.by_infohash[infohash] = task
+
+    # 合并新拉取的任务列表：更新已有任务的状态并加入新任务，保留列表快照之后才加入的任务（如本轮刚提交的）
+    def merge(self, other):
+        for task in other.by_id.values():
+            self.add(task)
+
+    def find(self, name=None, file_hash=None, url=None, infohash=None):
+        if infohash and infohash in self.by_infohash:
+            return self.by_infohash[infohash]
+        if name and name in self.by_name:
+            return self.by_name[name]
+        if file_hash and file_hash.lower() in self.by_hash:
+            return self.by_hash[file_hash.lower()]
+        if url and url in self.by_url:
+            return self.by_url[url]
+        return None
+
+
+# 在所有账号的任务索引中查找已存在的离线任务，避免同一条目在不同账号重复提交
+def find_existing_task(name=None, file_hash=None, url=None, infohash=None):
+    for task_index in TASK_INDEXES:
+        if task_index is not None:
+            task = task_index.find(name=name, file_hash=file_hash, url=url, infohash=infohash)
+            if task:
+                return task
+    return None
+
+
+# 为待处理条目分配账号：订阅指定了账号则使用该账号，否则分配给活跃离线任务最少的可用账号
+def assign_accounts(entries):
+    load = {
+        i: TASK_INDEXES[i].active if TASK_INDEXES[i] is not None else 0
+        for i, client in enumerate(PIKPAK_CLIENTS) if client
+    }
+    accounts = []
+    for entry in entries:
+        account = entry_account(entry)
+        if account != entry.get('account'):
+            # 重试条目保存的账号已从配置中移除或调整了顺序；移除时改为自动分配，原账号的保存路径也不再适用
+            if account is None:
+                entry['path'] = None
+            entry['account'] = account
+        if account is None and load:
+            account = min(load, key=load.get)
+        if account in load:
+            load[account] += 1
+        accounts.append(account if account is not None else 0)
+    return accounts
+
+
+# 条目所属账号的当前下标：按保存的用户名重新解析（旧记录没有用户名时检查下标是否越界），账号已不存在时返回 None
+def entry_account(entry):
+    name = entry.get('account_name')
+    if name is not None:
+        return USER.index(name) if name in USER else None
+    account = entry.get('account')
+    return account if account is not None and 0 <= account < len(USER) else None
+
+
+# 拉取完整的离线任务列表（跟随分页）并构建索引，每轮检查只调用一次
+async def build_task_index(account_index):
+    client = PIKPAK_CLIENTS[account_index]
+    if not client:
+        return None
+    index = TaskIndex()
+    try:
+        for task in await list_all_pages(client.offline_list, 'tasks', phase=TASK_INDEX_PHASES):
+            index.add(task)
+    except Exception as e:
+        console.log(f"[yellow]账号 {USER[account_index]} 获取离线任务列表失败: {e}，本轮将跳过该账号的任务查重。[/yellow]")
+        return None
+    console.log(f"账号 [cyan]{USER[account_index]}[/cyan] 已加载离线任务索引: {len(index)} 个任务 ({index.active} 个进行中)")
+    return index
+
+
+# 标题过滤器：包含 / 排除规则各自合并为一个预编译的正则（任一包含规则匹配且没有排除规则匹配时保留）
+class TitleFilter:
+    def __init__(self, include=(), exclude=()):
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+
+    @staticmethod
+    def compile(patterns):
+        if not patterns:
+            return None
+        parts = []
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+                parts.append(f"(?:{pattern})")
+            except re.error as e:
+                console.log(f"[yellow]过滤规则不是有效的正则表达式 ({e})，按普通文本匹配: {pattern}[/yellow]")
+                parts.append(re.escape(pattern))
+        return re.compile("|".join(parts), re.IGNORECASE)
+
+    def __call__(self, title):
+        if self.include is not None and not self.include.search(title):
+            return False
+        return self.exclude is None or not self.exclude.search(title)
+
+
+# 解析番剧标题，返回字幕组、番剧名、集数、版本、分辨率和字幕语言；无法识别集数时 episode 为 None
+def parse_title(title):
+    group_match = TITLE_GROUP_PATTERN.match(title)
+    group = group_match.group(1).strip() if group_match else None
+    rest = TITLE_NOISE_PATTERN.sub(" ", title[group_match.end():] if group_match else title)
+
+    series, episode, version = None, None, 1
+    tail = rest  # 集数之后的部分，分辨率和语言标签只在这里查找，避免误匹配番剧名
+    for pattern in TITLE_EPISODE_PATTERNS:
+        match = pattern.search(rest)
+        if match:
+            tail = rest[match.end():]
+            episode = int(match.group(1))
+            version = int(match.group(2) or 1)
+            prefix = rest[:match.start()]
+            bare = TITLE_BRACKET_PATTERN.sub(" ", prefix).strip()
+            brackets = [token.strip() for token in TITLE_BRACKET_PATTERN.findall(prefix) if token.strip()]
+            series = bare or (brackets[-1] if brackets else None)
+            break
+
+    resolution = None
+    for match in TITLE_RESOLUTION_PATTERN.finditer(tail):
+        value = 2160 if match.group(2) else int(match.group(1))
+        if value in KNOWN_RESOLUTIONS:
+            resolution = value
+            break
+    languages = [language for language, pattern in TITLE_LANGUAGE_PATTERNS.items() if pattern.search(tail)]
+
+    series_key = re.sub(r"[\W_]+", " ", series.lower()).strip() if series else None
+    return {
+        "group": group,
+        "series": series,
+        "episode": episode,
+        "version": version,
+        "resolution": resolution,
+        "languages": languages,
+        "key": f"{series_key}#{episode}" if series_key and episode is not None else None,
+    }
+
+
+# 版本排序依据：版本号 > 分辨率偏好 > 字幕语言偏好，越大越好
+def release_rank(release):
+    resolution = release.get("resolution") or 0
+    if PREFER_RESOLUTION:
+        resolution = len(PREFER_RESOLUTION) - PREFER_RESOLUTION.index(resolution) if resolution in PREFER_RESOLUTION else 0
+    languages = release.get("languages") or []
+    language = max((len(PREFER_LANGUAGE) - PREFER_LANGUAGE.index(item) for item in languages if item in PREFER_LANGUAGE), default=0)
+    return (release.get("version") or 1, resolution, language)
+
+
+# 此前的轮次中是否已经提交过同一集不差于该版本的条目
+def release_is_covered(release, guid):
+    rank = release_rank(release)
+    for row in STATE_DB.execute(
+        "SELECT data FROM entries WHERE release_key = ? AND guid != ? AND state IN (?, ?)",
+        (release["key"], guid, ENTRY_TASK_SUBMITTED, ENTRY_TASK_COMPLETED),
+    ):
+        if release_rank(json.loads(row["data"]).get("release") or {}) >= rank:
+            return True
+    return False
+
+
+# 在任何网络请求之前过滤新条目：应用订阅的包含 / 排除规则，同一番剧同一集只保留最优版本
+def filter_entries(entries):
+    kept = []
+    best = {}  # 番剧#集数 -> 本轮最优条目
+    for entry in entries:
+        feed_filter = FEEDS[entry['feed']].get("filter") if entry.get('feed') is not None else None
+        if feed_filter is not None and not feed_filter(entry['title']):
+            record_entry(entry, ENTRY_FILTERED, error="不符合订阅过滤规则")
+            continue
+        entry['release'] = release = parse_title(entry['title'])
+        key = release['key']
+        if not BEST_RELEASE_ONLY or key is None:
+            kept.append(entry)
+            continue
+        current = best.get(key)
+        if current is None or release_rank(release) > release_rank(current['release']):
+            if current is not None:
+                record_entry(current, ENTRY_FILTERED, error=f"同一集有更优版本: {entry['title']}")
+            best[key] = entry
+        else:
+            record_entry(entry, ENTRY_FILTERED, error=f"同一集有更优版本: {current['title']}")
+
+    for key, entry in best.items():
+        if release_is_covered(entry['release'], entry['guid']):
+            record_entry(entry, ENTRY_FILTERED, error="同一集已提交过不差于此的版本")
+        else:
+            kept.append(entry)
+    dropped = len(entries) - len(kept)
+    if dropped:
+        console.log(f"订阅过滤: 保留 {len(kept)} 个条目，排除 {dropped} 个")
+    return kept
+
+
+# 从状态数据库加载 RSS 轮询状态
+def load_feed_state():
+    for row in STATE_DB.execute("SELECT * FROM feeds"):
+        FEED_STATE[row["url"]] = {
+            'etag': row["etag"],
+            'last_modified': row["last_modified"],
+            'watermark': row["watermark"],
+            'seen': json.loads(row["seen"]),
+            'cadence': json.loads(row["cadence"] or "{}"),
+        }
+
+
+# 本轮条目处理完毕后再提交 RSS 轮询状态，避免中途退出时丢失条目
+def commit_feed_state():
+    if not _pending_feed_state:
+        return
+    try:
+        with STATE_DB:
+            STATE_DB.execute("BEGIN")
+            for url, state in _pending_feed_state.items():
+                store_feed_state(url, state)
+    except Exception as e:
+        console.log(f"[red]RSS 轮询状态保存失败: {str(e)}[/red]")
+        return
+    FEED_STATE.update(_pending_feed_state)
+    _pending_feed_state.clear()
+
+
+# 条目的发布时间（UTC 时间戳），无法解析时返回 None
+def entry_timestamp(entry):
+    parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+    return calendar.timegm(parsed) if parsed else None
+
+
+# 更新订阅的发布规律样本：history 为最近的发布时间，lags 为发现新条目时距其发布时间的延迟
+# （mikan 的 pubDate 不带时区，用延迟的中位数修正时区偏差）
+def update_cadence(state, entries, new_entries):
+    cadence = state.get('cadence') or {}
+    history = set(cadence.get('history', []))
+    history.update(entry['published'] for entry in entries if entry['published'] is not None)
+    lags = cadence.get('lags', [])
+    if state:  # 首次轮询时的条目可能是很久以前发布的，不计入延迟
+        now = time.time()
+        lags = (lags + [now - entry['published'] for entry in new_entries if entry['published'] is not None])[-FEED_HISTORY_SIZE:]
+    return {'history': sorted(history)[-FEED_HISTORY_SIZE:], 'lags': lags}
+
+
+# 发布时间的修正量：延迟的中位数超过半小时时按半小时取整（时区偏差），否则为 0
+def cadence_offset(cadence):
+    lags = sorted(cadence.get('lags', []))
+    if not lags:
+        return 0
+    median = lags[len(lags) // 2]
+    return round(median / 1800) * 1800 if abs(median) > 1800 else 0
+
 
-    # await auto_refresh_token() # Refresh token is handled in main loop
+# 根据订阅的发布规律计算下次轮询前的等待时间（秒）
+# 处于预计发布时段内时按最短间隔轮询；其余时间按连续空轮询次数指数退避，但不会错过下一个发布时段
+def next_poll_delay(feed_index, found_new):
+    url = FEEDS[feed_index]['url']
+    _feed_backoff[url] = 0 if found_new else _feed_backoff.get(url, 0) + 1
+    cadence = FEED_STATE.get(url, {}).get('cadence') or {}
+    history = cadence.get('history', [])
+    if len(history) < FEED_CADENCE_MIN_SAMPLES:
+        return INTERVAL_TIME_RSS
+    now = time.time()
+    offset = cadence_offset(cadence)
+    until_window = FEED_CADENCE_PERIOD
+    for published in history:
+        # 该发布时间在本周期内最近一次（已过去）的对应时刻
+        last = now - (now - published - offset) % FEED_CADENCE_PERIOD
+        upcoming = last + FEED_CADENCE_PERIOD - FEED_WINDOW_BEFORE - now
+        if now <= last + FEED_WINDOW_AFTER or upcoming <= 0:
+            return FEED_MIN_INTERVAL
+        until_window = min(until_window, upcoming)
+    backoff = FEED_MIN_INTERVAL * 2 ** min(_feed_backoff[url], 20)
+    return max(FEED_MIN_INTERVAL, min(FEED_MAX_INTERVAL, backoff, until_window))
 
 
-# 定时刷新 token
-async def auto_refresh_token():
-    global last_refresh_time
-    current_time = time.time()
-    # Check if client exists and token needs refresh
-    if PIKPAK_CLIENTS[0] and (current_time - last_refresh_time >= INTERVAL_TIME_REFRESH):
-        console.log("尝试刷新 token...")
-        try:
-            client = PIKPAK_CLIENTS[0]
-            await client.refresh_access_token()
-            console.log("[green]token 刷新成功！[/green]")
-            last_refresh_time = current_time
-            save_client()
-        except Exception as e:
-            console.log(f"[red]token 刷新失败: {str(e)}[/red]")
-            last_refresh_time = 0 # Reset time to force login next time
-            # Consider attempting relogin here or marking client as invalid
-            try:
-                 console.log("[yellow]尝试重新登录...[/yellow]")
-                 await PIKPAK_CLIENTS[0].login()
-                 console.log(f"账号 [cyan]{USER[0]}[/cyan] 重新登录成功！")
-                 save_client()
-            except Exception as login_e:
-                 console.log(f"[red]重新登录失败: {login_e}[/red]")
-                 PIKPAK_CLIENTS[0] = None # Mark client as invalid
-
-
-# 解析 RSS 并返回种子列表
-async def get_rss():
-    console.log(f"正在解析 RSS: [link={RSS[0]}]{RSS[0]}[/link]")
+# 解析 RSS 并返回新条目列表
+# 使用 ETag / Last-Modified 条件请求，304 表示没有更新；只返回高于水位线且未处理过的条目
+@instrument("get_rss")
+async def get_rss(feed_index):
+    feed = FEEDS[feed_index]
+    rss_url = feed['url']
+    console.log(f"正在解析 RSS: [link={rss_url}]{rss_url}[/link]")
+    state = FEED_STATE.get(rss_url, {})
     try:
-        rss = feedparser.parse(RSS[0])
+        response = await with_retry(http_get, rss_url, state.get('etag'), state.get('last_modified'))
+        if response.status_code == 304:
+            console.log("RSS 未更新，跳过解析。")
+            return []
+        import feedparser
+        rss = feedparser.parse(response.content)
         if rss.bozo:
+            count_feed_failure()
             console.log(f"[red]RSS 解析错误: {rss.bozo_exception}[/red]")
             return []
         entries = [
@@ -210,65 +1703,243 @@ async def get_rss():
                 'title': entry.get('title', 'N/A'),
                 'link': entry.get('link', 'N/A'),
                 'torrent': entry.enclosures[0]['url'] if entry.get('enclosures') else 'N/A',
-                'pubdate': entry.get('published', '').split("T")[0] if entry.get('published') else 'N/A'
+                'pubdate': entry.get('published', '').split("T")[0] if entry.get('published') else 'N/A',
+                'guid': entry.get('id') or entry.get('link') or entry.get('title', 'N/A'),
+                'infohash': infohash_from_name(entry.enclosures[0]['url'].split('/')[-1]) if entry.get('enclosures') else None,
+                'published': entry_timestamp(entry),
+                'feed': feed_index,
+                'account': feed['account'],
+                'account_name': USER[feed['account']] if feed['account'] is not None else None,
+                'path': feed['path'],
             }
             for entry in rss.get('entries', [])
         ]
+
+        watermark = state.get('watermark')
+        seen = set(state.get('seen', []))
+        new_entries = [
+            entry for entry in entries
+            if entry['guid'] not in seen
+            and (watermark is None or entry['published'] is None or entry['published'] >= watermark)
+        ]
+        timestamps = [entry['published'] for entry in entries if entry['published'] is not None]
+        _pending_feed_state[rss_url] = {
+            'etag': response.headers.get('etag'),
+            'last_modified': response.headers.get('last-modified'),
+            'watermark': max(timestamps + ([watermark] if watermark is not None else []), default=None),
+            'seen': [entry['guid'] for entry in entries],
+            'cadence': update_cadence(state, entries, new_entries),
+        }
         # console.log(f"成功解析到 {len(entries)} 个条目") # Replaced by table
 
-        if entries:
-            table = Table(title=f"RSS 源解析结果 ({len(entries)} 条)", show_header=True, header_style="bold magenta")
+        if new_entries and HEADLESS:
+            for entry in new_entries:
+                emit_event("entry_seen", feed=rss_url, guid=entry['guid'], title=entry['title'],
+                           torrent=entry['torrent'], infohash=entry['infohash'], pubdate=entry['pubdate'])
+        elif new_entries:
+            from rich.table import Table
+            table = Table(title=f"RSS 新条目 ({len(new_entries)}/{len(entries)} 条)", show_header=True, header_style="bold magenta")
             table.add_column("发布日期", style="dim", width=12)
             table.add_column("标题")
             table.add_column("Torrent 链接", style="blue")
 
-            for entry in entries:
+            for entry in new_entries:
                 table.add_row(
                     entry['pubdate'],
                     entry['title'],
                     f"[link={entry['torrent']}]...{entry['torrent'][-20:]}[/link]" if entry['torrent'] != 'N/A' else 'N/A'
                 )
             console.print(table)
+        elif entries:
+            console.log(f"RSS 中的 {len(entries)} 个条目均已处理，没有新条目。")
         else:
             console.log("[yellow]RSS 源中未找到有效条目。[/yellow]")
 
-        return entries
+        return new_entries
     except Exception as e:
+        count_error("get_rss", e)
+        count_feed_failure()
         console.log(f"[red]获取或解析 RSS 失败: {e}[/red]")
         return []
 
 
+# 文件夹缓存的键：(父文件夹 ID, 文件夹名称)
+def folder_cache_key(parent_id, name):
+    return f"{parent_id}/{name}"
+
+
+# 从状态数据库加载日期文件夹 ID 缓存
+def load_folder_cache():
+    FOLDER_CACHE.update((row["key"], row["folder_id"]) for row in STATE_DB.execute("SELECT key, folder_id FROM folders"))
+    if FOLDER_CACHE:
+        console.log(f"[green]已加载文件夹缓存: {len(FOLDER_CACHE)} 条[/green]")
+
+
+# 缓存并持久化一个文件夹 ID
+def store_folder(key, folder_id):
+    FOLDER_CACHE[key] = folder_id
+    try:
+        STATE_DB.execute("INSERT OR REPLACE INTO folders (key, folder_id) VALUES (?, ?)", (key, folder_id))
+    except Exception as e:
+        console.log(f"[red]文件夹缓存保存失败: {str(e)}[/red]")
+
+
+# PikPak 报告文件夹不存在（例如被手动删除）时，移除对应的缓存项
+def invalidate_folder(folder_id):
+    stale_keys = [key for key, value in FOLDER_CACHE.items() if value == folder_id]
+    for key in stale_keys:
+        del FOLDER_CACHE[key]
+    LISTING_CACHE.discard(folder_id)
+    if stale_keys:
+        console.log(f"[yellow]文件夹 {folder_id} 已不存在，清除缓存: {', '.join(stale_keys)}[/yellow]")
+        STATE_DB.execute("DELETE FROM folders WHERE folder_id = ?", (folder_id,))
+    return bool(stale_keys)
+
+
+# 判断 PikPak 返回的错误是否表示文件 / 文件夹不存在
+def is_not_found_error(error):
+    message = str(error).lower()
+    return any(keyword in message for keyword in ("not found", "not_found", "not exist", "不存在"))
+
+
+# 文件夹内容缓存：(账号, 父文件夹 ID, 名称过滤) -> 文件列表，带 TTL 和 LRU 淘汰
+# 自己创建的文件夹和提交的任务直接写入缓存，因此同一轮内的重复查询无需再调用 API
+class ListingCache:
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()  # 键 -> (过期时间, 文件列表)
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return item[1]
+
+    def put(self, key, files):
+        self.entries[key] = (time.monotonic() + self.ttl, files)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    # 把新写入的文件加入父文件夹已缓存的列表（名称过滤不匹配的列表除外）
+    def add_file(self, account, parent_id, file):
+        for (cached_account, cached_parent, name), (_, files) in self.entries.items():
+            if cached_account == account and cached_parent == parent_id and name in (None, file.get('name')):
+                files.append(file)
+
+    # 文件夹或文件被删除时，丢弃以它为父文件夹或包含它的缓存列表
+    def discard(self, file_id):
+        stale_keys = [
+            key for key, (_, files) in self.entries.items()
+            if key[1] == file_id or any(file.get('id') == file_id for file in files)
+        ]
+        for key in stale_keys:
+            del self.entries[key]
+
+
+LISTING_CACHE = ListingCache(LISTING_CACHE_TTL, LISTING_CACHE_SIZE)
+
+
+# 按 next_page_token 逐页调用列表接口，返回所有页的 items_key 项
+async def list_all_pages(method, items_key, **kwargs):
+    items = []
+    page_token = None
+    while True:
+        result = await api_call(method, next_page_token=page_token, **kwargs)
+        items += result.get(items_key, [])
+        next_page_token = result.get('next_page_token')
+        if not next_page_token or next_page_token == page_token:
+            return items
+        page_token = next_page_token
+
+
+# 列出文件夹内容（读取所有分页并缓存）；指定 name 时使用服务端名称过滤
+async def list_folder(account_index, parent_id, name=None):
+    key = (USER[account_index], parent_id, name)
+    files = LISTING_CACHE.get(key)
+    if files is not None:
+        return files
+    filters = {"name": {"eq": name}} if name is not None else None
+    files = await list_all_pages(
+        PIKPAK_CLIENTS[account_index].file_list, 'files',
+        size=LISTING_PAGE_SIZE, parent_id=parent_id, additional_filters=filters,
+    )
+    if name is not None:
+        files = [file for file in files if file.get('name') == name]
+    LISTING_CACHE.put(key, files)
+    return files
+
+
 # 根据种子对应的发布时间获取或创建存放该种子的文件夹
+# 结果按 (父文件夹 ID, 日期) 缓存并持久化；同一日期的并发查询共享同一次请求，保证只创建一次文件夹
+@instrument("get_folder_id")
 async def get_folder_id(account_index, torrent_info):
     client = PIKPAK_CLIENTS[account_index]
     if not client:
         console.log(f"[red]账号 {account_index} 客户端无效，无法获取文件夹ID。[/red]")
         return None
-    folder_path = PATH[account_index]
+    folder_path = torrent_info.get('path') or PATH[account_index]
     pubdate = torrent_info['pubdate'] # Use pubdate from torrent_info
     if not pubdate or pubdate == 'N/A':
         console.log(f"[yellow]无法获取发布日期，将使用根目录: {torrent_info['title']}[/yellow]")
         return folder_path # Use root path if no date
 
+    key = folder_cache_key(folder_path, pubdate)
+    if key in FOLDER_CACHE:
+        return FOLDER_CACHE[key]
+
+    lookup = _folder_lookups.get(key)
+    if lookup is None:
+        lookup = asyncio.ensure_future(resolve_folder(account_index, folder_path, pubdate))
+        _folder_lookups[key] = lookup
+        lookup.add_done_callback(lambda _: _folder_lookups.pop(key, None))
+    # shield：其中一个等待方被取消时，不能连带取消其他条目共享的查询
+    return await asyncio.shield(lookup)
+
+
+# 在父文件夹中查找日期文件夹，不存在则创建，并写入缓存
+async def resolve_folder(account_index, folder_path, pubdate):
+    client = PIKPAK_CLIENTS[account_index]
     console.log(f"检查日期文件夹 [magenta]{pubdate}[/magenta] 是否存在...")
     try:
-        # 获取文件夹列表
-        folder_list = await client.file_list(parent_id=folder_path)
-        for file in folder_list.get('files', []):
-            if file.get('kind') == 'drive#folder' and file.get('name') == pubdate:
+        # 按名称过滤并读取所有分页，父文件夹中有大量日期文件夹时也不会漏掉
+        folder_id = None
+        for file in await list_folder(account_index, folder_path, pubdate):
+            if file.get('kind') == 'drive#folder':
                 console.log(f"找到文件夹 [magenta]{pubdate}[/magenta] (ID: {file['id']})")
-                return file['id']
-        # 未找到则创建新文件夹
-        console.log(f"文件夹 [magenta]{pubdate}[/magenta] 不存在，正在创建...")
-        folder_info = await client.create_folder(name=pubdate, parent_id=folder_path)
-        new_folder_id = folder_info.get('file', {}).get('id')
-        if new_folder_id:
-            console.log(f"[green]成功创建文件夹[/green] [magenta]{pubdate}[/magenta] (ID: {new_folder_id})")
-            return new_folder_id
-        else:
-            console.log(f"[red]创建文件夹 {pubdate} 失败: 返回信息不包含 ID[/red]")
-            return None
+                folder_id = file['id']
+                break
+        if not folder_id:
+            # 未找到则创建新文件夹
+            console.log(f"文件夹 [magenta]{pubdate}[/magenta] 不存在，正在创建...")
+            try:
+                folder_info = await api_call(client.create_folder, name=pubdate, parent_id=folder_path)
+            except Exception as e:
+                if not write_may_have_applied(e):
+                    raise
+                # 请求可能已经生效：重新列出父文件夹确认，避免下次重复创建同名文件夹
+                LISTING_CACHE.discard(folder_path)
+                folder = next((file for file in await list_folder(account_index, folder_path, pubdate) if file.get('kind') == 'drive#folder'), None)
+                if folder is None:
+                    raise
+                console.log(f"[yellow]创建文件夹请求出错 ({e})，但文件夹已创建: {pubdate}[/yellow]")
+                folder_info = {'file': folder}
+            folder_id = folder_info.get('file', {}).get('id')
+            if not folder_id:
+                console.log(f"[red]创建文件夹 {pubdate} 失败: 返回信息不包含 ID[/red]")
+                return None
+            LISTING_CACHE.add_file(USER[account_index], folder_path, folder_info['file'])
+            LISTING_CACHE.put((USER[account_index], folder_id, None), [])
+            console.log(f"[green]成功创建文件夹[/green] [magenta]{pubdate}[/magenta] (ID: {folder_id})")
+        store_folder(folder_cache_key(folder_path, pubdate), folder_id)
+        return folder_id
     except Exception as e:
+        count_error("get_folder_id", e)
         console.log(f"[red]获取或创建文件夹 {pubdate} 失败: {e}[/red]")
         return None
 
@@ -284,186 +1955,1142 @@ async def get_folder_id(account_index, torrent_info):
 
 
 # 提交离线磁力任务至 PikPak
+@instrument("magnet_upload")
 async def magnet_upload(account_index, torrent_info, folder_id):
     client = PIKPAK_CLIENTS[account_index]
     if not client:
         console.log(f"[red]账号 {account_index} 客户端无效，无法添加离线任务。[/red]")
         return None, None
-    file_url = torrent_info['torrent']
+    # 已知 infohash 时提交磁力链接，PikPak 无需再次下载种子文件
+    file_url = torrent_info.get('magnet') or torrent_info['torrent']
     title = torrent_info['title']
     console.log(f"准备添加离线任务: [blue]{title}[/blue] 到文件夹 ID: {folder_id}")
     try:
-        result = await client.offline_download(file_url=file_url, parent_id=folder_id)
+        result = await api_call(client.offline_download, file_url=file_url, parent_id=folder_id)
         task_id = result.get('task', {}).get('id')
         task_name = result.get('task', {}).get('name')
         if task_id:
+            # 本轮后续条目查重时也能命中刚提交的任务
+            if TASK_INDEXES[account_index] is not None:
+                TASK_INDEXES[account_index].add(result['task'])
+            LISTING_CACHE.add_file(USER[account_index], folder_id, {
+                'id': result['task'].get('file_id'), 'name': result['task'].get('file_name') or task_name,
+                'kind': 'drive#file', 'params': {'task_name': title, 'url': file_url},
+            })
             console.log(f"[green]账号 {USER[account_index]} 添加离线任务成功:[/green] [blue]{task_name}[/blue] (ID: {task_id})")
             return task_id, task_name
         else:
             console.log(f"[red]账号 {USER[account_index]} 添加离线任务失败: 返回结果未包含任务信息. URL: {file_url}[/red]")
             return None, None
     except Exception as e:
+        if write_may_have_applied(e):
+            # 请求可能已经生效：重新拉取任务列表确认，已创建时视为提交成功，避免下一轮重复提交
+            task = await find_submitted_task(account_index, torrent_info, file_url)
+            if task:
+                console.log(f"[yellow]添加离线任务请求出错 ({e})，但任务已创建: {title} (ID: {task['id']})[/yellow]")
+                return task['id'], task.get('name')
+        count_error("magnet_upload", e)
         console.log(
             f"[red]账号 {USER[account_index]} 添加离线磁力任务失败: {e}. URL: {file_url}[/red]")
+        if is_not_found_error(e):
+            invalidate_folder(folder_id)
         return None, None
 
 
-# 下载 torrent 文件并保存到本地
-async def download_torrent(name, torrent_url, progress: Progress):
+# 重新拉取账号的离线任务列表（同时合并到本轮的任务索引快照），查找与条目对应的任务
+async def find_submitted_task(account_index, torrent_info, file_url):
+    task_index = await build_task_index(account_index)
+    if task_index is None:
+        return None
+    merge_task_index(account_index, task_index)
+    return task_index.find(infohash=torrent_info.get('infohash'), url=file_url)
+
+
+# 把新拉取的任务列表合并到共享的任务索引；RSS 检查的网络阶段可能正在并发提交任务，不能整体替换
+def merge_task_index(account_index, task_index):
+    if TASK_INDEXES[account_index] is None:
+        TASK_INDEXES[account_index] = TaskIndex()
+    TASK_INDEXES[account_index].merge(task_index)
+
+
+# 所有并发下载共用的一个汇总进度条：按字节累计，限制刷新频率，避免每个块都更新 Rich 进度条
+class TransferProgress:
+    def __init__(self, progress: "Progress", description):
+        self.progress = progress
+        self.task = progress.add_task(description, total=0, visible=False)
+        self.total = 0
+        self.completed = 0
+        self.updated = 0.0
+
+    # 开始一个新的传输，size 未知时为 0（完成时再按实际大小计入）
+    def start(self, size):
+        self.total += size
+        self.refresh()
+
+    def advance(self, amount):
+        self.completed += amount
+        if time.monotonic() - self.updated >= PROGRESS_REFRESH_INTERVAL:
+            self.refresh()
+
+    # 传输结束（成功或失败），按实际收到的字节修正总量
+    def finish(self, size, received):
+        self.total += received - size
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if force or now - self.updated >= PROGRESS_REFRESH_INTERVAL:
+            self.updated = now
+            self.progress.update(self.task, total=self.total, completed=self.completed, visible=True)
+
+
+# 把种子内容一次写入临时文件后原子重命名（在线程中执行）
+def write_torrent_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'wb') as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+# 下载 torrent 文件到内存（受种子下载并发限制，临时错误自动重试），返回文件内容
+@instrument("download_torrent")
+async def download_torrent(name, torrent_url, progress: TransferProgress):
+    import httpx
     console.log(f"准备下载种子文件: [blue]{name}[/blue] 从 [link={torrent_url}]{torrent_url}[/link]")
     try:
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            # Use stream=True for progress bar
-            async with client.stream("GET", torrent_url, timeout=60.0) as response:
-                response.raise_for_status() # Raise exception for bad status codes
-                total_size = int(response.headers.get('content-length', 0))
-                os.makedirs('torrent', exist_ok=True)
-                file_path = os.path.join('torrent', name)
-
-                # Use the passed progress object directly
-                download_task = progress.add_task(f"[cyan]下载 {name}...", total=total_size)
-                with open(file_path, 'wb') as f:
-                    async for chunk in response.aiter_bytes():
-                        f.write(chunk)
-                        progress.update(download_task, advance=len(chunk))
-                progress.remove_task(download_task) # Remove task when done
-
-        console.log(f"[green]种子文件下载完成:[/green] [blue]{file_path}[/blue]")
-        return file_path
+        async with TORRENT_SEMAPHORE:
+            data, spooled = await with_retry(fetch_torrent, name, torrent_url, progress)
+        console.log(f"[green]种子文件下载完成:[/green] [blue]{name}[/blue] ({len(data)} 字节)")
+        if SAVE_TORRENT_FILES and not spooled:
+            await asyncio.to_thread(write_torrent_file, os.path.join(TORRENT_DIR, name), data)
+        return data
     except httpx.HTTPStatusError as e:
+        count_error("download_torrent", e)
         console.log(f"[red]下载种子文件失败 (HTTP Status {e.response.status_code}): {name} from {torrent_url}[/red]")
         return None
     except Exception as e:
+        count_error("download_torrent", e)
         console.log(f"[red]下载种子文件时发生错误: {e}. URL: {torrent_url}[/red]")
         return None
 
 
-# 检查本地是否存在种子文件；若不存在则下载并提交离线任务
-async def check_torrent(account_index, torrent_info, check_mode: str, progress: Progress):
+# 单次下载 torrent 文件，出错时直接抛出由调用方决定是否重试；返回 (内容, 是否已另存到 TORRENT_DIR)
+# 小种子只缓存在内存中；需要另存的大种子边下载边在线程中写入临时文件，完成后原子重命名
+async def fetch_torrent(name, torrent_url, progress: TransferProgress):
+    path = os.path.join(TORRENT_DIR, name)
+    spool = None
+    received = 0
+    async with get_http_client().stream("GET", torrent_url) as response:
+        response.raise_for_status() # Raise exception for bad status codes
+        total_size = int(response.headers.get('content-length', 0))
+        progress.start(total_size)
+        chunks = []
+        try:
+            async for chunk in response.aiter_bytes():
+                chunks.append(chunk)
+                received += len(chunk)
+                progress.advance(len(chunk))
+                if SAVE_TORRENT_FILES and spool is None and received > TORRENT_SPOOL_SIZE:
+                    await asyncio.to_thread(os.makedirs, TORRENT_DIR, exist_ok=True)
+                    spool = await asyncio.to_thread(open, path + ".tmp", 'wb')
+                    await asyncio.to_thread(spool.writelines, chunks)
+                elif spool is not None:
+                    await asyncio.to_thread(spool.write, chunk)
+            if spool is not None:
+                await asyncio.to_thread(spool.close)
+                await asyncio.to_thread(os.replace, path + ".tmp", path)
+        except BaseException:
+            if spool is not None:
+                spool.close()
+                os.remove(path + ".tmp")
+            raise
+        finally:
+            progress.finish(total_size, received)
+    return b"".join(chunks), spool is not None
+
+
+# 记录条目处理失败；连续失败达到上限后放弃重试
+def fail_entry(torrent_info, reason):
+    retries = record_failure(torrent_info, reason)
+    if retries >= MAX_RETRY_CYCLES:
+        console.log(f"[red]条目连续 {retries} 轮处理失败，放弃重试: {torrent_info['title']}[/red]")
+    return None
+
+
+# 检查状态数据库中是否已处理过该条目；若没有则按 infohash 查重后提交离线任务
+# 种子链接中已含 infohash（如 mikan）时无需下载种子文件
+# 网络模式返回 True 表示已提交，False 表示已存在而跳过，None 表示处理失败（下一轮重试）
+@instrument("check_torrent")
+async def check_torrent(account_index, torrent_info, check_mode: str, progress: TransferProgress):
     name = torrent_info['torrent'].split('/')[-1]
     torrent_url = torrent_info['torrent']
     title = torrent_info['title']
-    local_path = os.path.join('torrent', name)
 
-    if not os.path.exists(local_path):
-        console.log(f"本地未找到种子文件: [blue]{name}[/blue]")
-        if check_mode == "local":
-            return True # Needs network check
-        else:
-            client = PIKPAK_CLIENTS[account_index]
-            if not client:
-                 console.log(f"[red]账号 {account_index} 客户端无效，无法检查云端任务。[/red]")
-                 return False
+    if check_mode == "local":
+        if entry_is_done(torrent_info):
+            # console.log(f"本地已存在种子文件: [blue]{name}[/blue]") # Reduce verbosity
+            DEDUP_RESULTS.inc(result="hit", source="state")
+            return False # Already processed, no network check needed
+        console.log(f"未处理过的条目: [blue]{name}[/blue]")
+        if find_entry_record(torrent_info) is None:
+            record_entry(torrent_info, ENTRY_SEEN)
+        return True # Needs network check
 
-            # --- Optimization: Check global task list first ---
-            try:
-                console.log(f"检查全局离线任务列表是否存在: [blue]{title}[/blue]")
-                tasks = await client.offline_list()
-                for task in tasks.get('tasks', []):
-                    # Check if task name matches the torrent title
-                    if task.get('name') == title:
-                        console.log(f"[yellow]全局离线任务已存在，跳过添加: {title} (任务状态: {task.get('status_text', '未知')})[/yellow]")
-                        return False # Already exists in global tasks
-            except Exception as e:
-                console.log(f"[yellow]检查全局离线任务列表失败: {e}，将继续后续检查。[/yellow]")
-            # --- End Optimization ---
+    client = PIKPAK_CLIENTS[account_index]
+    if not client:
+         console.log(f"[red]账号 {account_index} 客户端无效，无法检查云端任务。[/red]")
+         return fail_entry(torrent_info, "客户端无效")
+
+    # --- Optimization: Check the per-cycle task index snapshot first ---
+    infohash = torrent_info.get('infohash')
+    task = find_existing_task(name=title, url=torrent_url, infohash=infohash)
+    if task:
+        console.log(f"[yellow]全局离线任务已存在，跳过添加: {title} (任务状态: {task.get('phase', '未知')})[/yellow]")
+        record_entry(torrent_info, ENTRY_TASK_SUBMITTED, task_id=task.get('id'))
+        DEDUP_RESULTS.inc(result="hit", source="task_index")
+        return False # Already exists in global tasks
+    # --- End Optimization ---
+
+    trackers = []
+    if not infohash:
+        # 种子链接中不含 infohash，下载种子并在内存中计算
+        data = await download_torrent(name, torrent_url, progress)
+        if data is None:
+            return fail_entry(torrent_info, "种子下载失败") # Download failed, skip upload
+        try:
+            torrent = parse_torrent(data)
+        except ValueError as e:
+            count_error("check_torrent", e)
+            console.log(f"[red]种子文件解析失败: {e}. URL: {torrent_url}[/red]")
+            return fail_entry(torrent_info, f"种子文件解析失败: {e}")
+        infohash, trackers = torrent['infohash'], torrent['trackers']
+        torrent_info = {**torrent_info, 'infohash': infohash}
+        record_entry(torrent_info, ENTRY_TORRENT_FETCHED)
+        task = find_existing_task(infohash=infohash)
+        if task:
+            console.log(f"[yellow]相同 infohash 的离线任务已存在，跳过添加: {title} ({infohash})[/yellow]")
+            record_entry(torrent_info, ENTRY_TASK_SUBMITTED, task_id=task.get('id'))
+            DEDUP_RESULTS.inc(result="hit", source="task_index")
+            return False
+
+    if infohash_is_done(infohash, torrent_info['guid']):
+        console.log(f"[yellow]相同 infohash 的条目已提交过，跳过添加: {title} ({infohash})[/yellow]")
+        record_entry(torrent_info, ENTRY_TASK_SUBMITTED)
+        DEDUP_RESULTS.inc(result="hit", source="state")
+        return False
+    if infohash in _inflight_infohashes:
+        console.log(f"[yellow]相同 infohash 的条目正在处理，跳过添加: {title} ({infohash})[/yellow]")
+        DEDUP_RESULTS.inc(result="hit", source="inflight")
+        return False
+    DEDUP_RESULTS.inc(result="miss", source="infohash")
+
+    _inflight_infohashes.add(infohash)
+    try:
+        torrent_info = {**torrent_info, 'magnet': build_magnet(infohash, title, trackers)}
+        return await submit_entry(account_index, torrent_info)
+    finally:
+        _inflight_infohashes.discard(infohash)
+
+
+# 获取目标文件夹并提交离线任务
+async def submit_entry(account_index, torrent_info):
+    title = torrent_info['title']
 
-            # Download torrent using the passed progress object
-            downloaded_path = await download_torrent(name, torrent_url, progress)
-            if not downloaded_path:
-                return False # Download failed, skip upload
+    # Get folder ID
+    folder_id = await get_folder_id(account_index, torrent_info)
+    if not folder_id:
+        console.log(f"[red]无法获取或创建目标文件夹，跳过离线任务: {title}[/red]")
+        return fail_entry(torrent_info, "无法获取或创建目标文件夹") # Folder creation failed, skip upload
 
-            # Get folder ID
+    # Fallback: Check if file already exists in the target folder (using name as a simple check)
+    # This is kept as a secondary check in case the global task list check fails or misses something
+    try:
+        console.log(f"检查云端文件夹 [magenta]{folder_id}[/magenta] 是否已存在文件: [blue]{title}[/blue]")
+        for sub_file in await list_folder(account_index, folder_id):
+             if (sub_file.get('name') == title or
+                (sub_file.get('params') and sub_file['params'].get('task_name') == title) or
+                (sub_file.get('params') and sub_file['params'].get('filename') == title)):
+                 console.log(f"[yellow]云端文件夹中已存在同名文件，跳过添加: {title}[/yellow]")
+                 record_entry(torrent_info, ENTRY_TASK_COMPLETED, folder_id=folder_id)
+                 DEDUP_RESULTS.inc(result="hit", source="folder")
+                 return False # Already exists in folder
+    except Exception as e:
+        console.log(f"[yellow]检查云端文件夹失败: {e}，将尝试添加任务。[/yellow]")
+        if is_not_found_error(e) and invalidate_folder(folder_id):
+            # 缓存的文件夹已被删除，重新查找或创建
             folder_id = await get_folder_id(account_index, torrent_info)
             if not folder_id:
                 console.log(f"[red]无法获取或创建目标文件夹，跳过离线任务: {title}[/red]")
-                return False # Folder creation failed, skip upload
+                return fail_entry(torrent_info, "无法获取或创建目标文件夹")
+    record_entry(torrent_info, ENTRY_FOLDER_RESOLVED, folder_id=folder_id)
+
+    # 提交前确认认领仍属于本实例（续租不及时、已被其他实例接管时放弃）
+    key = _claims.get(torrent_info['guid'])
+    if key is not None and not await lease_call(holds_lease, key):
+        console.log(f"[yellow]认领已被其他实例接管，跳过添加: {title}[/yellow]")
+        return False
+
+    # Upload magnet
+    task_id, _ = await magnet_upload(account_index, torrent_info, folder_id)
+    if not task_id:
+        return fail_entry(torrent_info, "添加离线任务失败")
+    if key is not None:
+        # 提交后立即标记认领完成，不必等到整轮结束，其他实例之后认领时直接跳过
+        try:
+            await lease_call(release_leases, [key], done=True)
+        except Exception as e:
+            console.log(f"[yellow]标记认领完成失败: {e}[/yellow]")
+    record_entry(torrent_info, ENTRY_TASK_SUBMITTED, account=USER[account_index], folder_id=folder_id, task_id=task_id)
+    emit_event("task_submitted", account=USER[account_index], task_id=task_id, guid=torrent_info['guid'],
+               title=torrent_info['title'], infohash=torrent_info.get('infohash'), folder_id=folder_id)
+    TRACKER_WAKEUP.set()
+    return True # Task submitted
+
+
+# 离线任务状态轮询：批量拉取各账号的任务列表，汇报进度、自动重试出错的任务并触发完成回调
+# 返回是否仍有进行中的任务
+async def track_tasks():
+    entries = load_tracked_entries()
+    if not entries:
+        return False
+    listed = set()  # 本次成功拉取了完整任务列表的账号
+    # 本次拉取的列表只用于状态轮询（判断任务是否已从列表中消失），同时合并到共享的任务索引供查重使用
+    indexes = await asyncio.gather(*(build_task_index(i) for i in range(len(PIKPAK_CLIENTS))))
+    for account_index, task_index in enumerate(indexes):
+        if task_index is not None:
+            merge_task_index(account_index, task_index)
+            listed.add(USER[account_index])
+
+    # 已结束的任务在同一个事务中认领，共用状态数据库的实例之间只有一个执行完成回调或重试
+    finished = [
+        f"task:{row['task_id']}" for row in entries
+        if (find_task_by_id(row["task_id"], indexes)[0] or {}).get('phase') in ("PHASE_TYPE_COMPLETE", "PHASE_TYPE_ERROR")
+    ]
+    task_claims = await claim_keys(finished) if finished else {}
+
+    running = completed = failed = 0
+    for row in entries:
+        task, account_index = find_task_by_id(row["task_id"], indexes)
+        if task is None:
+            # 任务尚未出现在列表中，或已被删除 / 清理；只在所属账号的列表拉取成功（或账号已从配置中移除）时计数
+            if row["account"] in listed or row["account"] not in USER:
+                record_task_miss(row)
+            continue
+        if row["task_misses"]:
+            STATE_DB.execute("UPDATE entries SET task_misses = 0 WHERE guid = ?", (row["guid"],))
+        entry = json.loads(row["data"])
+        phase = task.get('phase')
+        if phase in ACTIVE_TASK_PHASES:
+            running += 1
+            progress = task.get('progress', 0)
+            if _task_progress.get(row["task_id"]) != progress:
+                _task_progress[row["task_id"]] = progress
+                console.log(f"离线任务进度: [blue]{entry['title']}[/blue] {progress}%")
+        elif phase == "PHASE_TYPE_COMPLETE" and task_claims.get(f"task:{row['task_id']}") == LEASE_DONE:
+            # 其他实例已执行完成回调，本实例只停止跟踪
+            _task_progress.pop(row["task_id"], None)
+            record_entry(entry, ENTRY_TASK_COMPLETED, file_id=task.get('file_id'))
+        elif phase in ("PHASE_TYPE_COMPLETE", "PHASE_TYPE_ERROR") and task_claims.get(f"task:{row['task_id']}") != LEASE_CLAIMED:
+            continue # 共用状态数据库的其他实例正在处理该任务
+        elif phase == "PHASE_TYPE_COMPLETE":
+            completed += 1
+            _task_progress.pop(row["task_id"], None)
+            record_entry(entry, ENTRY_TASK_COMPLETED, file_id=task.get('file_id'))
+            console.log(f"[green]离线任务完成:[/green] [blue]{entry['title']}[/blue]")
+            await run_completion_hooks(entry, task)
+            if DOWNLOAD_DIR and task.get('file_id'):
+                start_download(download_entry(account_index, entry, task['file_id']))
+            await lease_call(release_leases, [f"task:{row['task_id']}"], done=True)
+        elif phase == "PHASE_TYPE_ERROR":
+            _task_progress.pop(row["task_id"], None)
+            if await retry_task(account_index, row, entry, task):
+                running += 1
+            else:
+                failed += 1
+            await lease_call(release_leases, [f"task:{row['task_id']}"])
+    console.log(f"离线任务状态: {running} 个进行中，{completed} 个新完成，{failed} 个失败。")
+    return running > 0
+
+
+# 跟踪的任务不在任务列表中：连续 TASK_MAX_MISSES 次后停止跟踪（记为已完成，不执行完成回调，也不再重新提交）
+def record_task_miss(row):
+    misses = row["task_misses"] + 1
+    if misses < TASK_MAX_MISSES:
+        STATE_DB.execute("UPDATE entries SET task_misses = ? WHERE guid = ?", (misses, row["guid"]))
+        return
+    entry = json.loads(row["data"])
+    record_entry(entry, ENTRY_TASK_COMPLETED, task_misses=misses, error="离线任务已不在任务列表中")
+    _task_progress.pop(row["task_id"], None)
+    console.log(f"[yellow]离线任务连续 {misses} 次不在任务列表中（可能已被删除或清理），停止跟踪: {entry['title']}[/yellow]")
+
+
+# 在各账号的任务索引（默认为共享的任务索引）中按 ID 查找任务，返回 (任务, 账号下标)
+def find_task_by_id(task_id, indexes=None):
+    for account_index, task_index in enumerate(TASK_INDEXES if indexes is None else indexes):
+        if task_index is not None and task_id in task_index.by_id:
+            return task_index.by_id[task_id], account_index
+    return None, None
+
+
+# 重试出错的离线任务，超过 TASK_MAX_RETRIES 次后将条目标记为失败，返回是否已重新提交
+async def retry_task(account_index, row, entry, task):
+    message = task.get('message') or '未知错误'
+    if row["task_retries"] >= TASK_MAX_RETRIES:
+        console.log(f"[red]离线任务多次出错，放弃重试: {entry['title']} ({message})[/red]")
+        # 重试次数记满，不会再作为失败条目重新提交
+        record_entry(entry, ENTRY_FAILED, retries=MAX_RETRY_CYCLES, error=message)
+        return False
+    try:
+        await api_call(PIKPAK_CLIENTS[account_index].offline_task_retry, row["task_id"])
+        STATE_DB.execute("UPDATE entries SET task_retries = task_retries + 1 WHERE guid = ?", (row["guid"],))
+        console.log(f"[yellow]离线任务出错 ({message})，已重试 ({row['task_retries'] + 1}/{TASK_MAX_RETRIES}): {entry['title']}[/yellow]")
+        return True
+    except Exception as e:
+        console.log(f"[red]重试离线任务失败: {e}. 任务: {entry['title']}[/red]")
+        return False
 
-            # Fallback: Check if file already exists in the target folder (using name as a simple check)
-            # This is kept as a secondary check in case the global task list check fails or misses something
+
+# 离线任务完成后依次调用 COMPLETION_HOOKS 和配置中的 on_complete 命令
+async def run_completion_hooks(entry, task):
+    for hook in COMPLETION_HOOKS:
+        try:
+            await hook(entry, task)
+        except Exception as e:
+            console.log(f"[red]完成回调执行失败: {e}[/red]")
+    if not ON_COMPLETE_COMMAND:
+        return
+    env = {
+        **os.environ,
+        "PIKPAK_TASK_ID": task.get('id') or "",
+        "PIKPAK_TASK_NAME": task.get('name') or "",
+        "PIKPAK_FILE_ID": task.get('file_id') or "",
+        "PIKPAK_TITLE": entry['title'],
+        "PIKPAK_INFOHASH": entry.get('infohash') or "",
+    }
+    try:
+        process = await asyncio.create_subprocess_shell(ON_COMPLETE_COMMAND, env=env)
+        if await process.wait() != 0:
+            console.log(f"[yellow]on_complete 命令退出码: {process.returncode}[/yellow]")
+    except Exception as e:
+        console.log(f"[red]on_complete 命令执行失败: {e}[/red]")
+
+
+# 后台运行任务状态轮询：有进行中的任务时按 TRACKER_MIN_INTERVAL 轮询，空闲时指数退避到 TRACKER_MAX_INTERVAL
+# 有新任务提交时立即恢复快速轮询
+async def run_tracker(stop_event):
+    interval = TRACKER_MIN_INTERVAL
+    while not stop_event.is_set():
+        TRACKER_WAKEUP.clear()
+        try:
+            active = await track_tasks()
+        except Exception:
+            console.log("[red]离线任务状态轮询失败:[/red]")
+            console.print_exception(show_locals=False)
+            active = False
+        interval = TRACKER_MIN_INTERVAL if active else min(interval * 2, TRACKER_MAX_INTERVAL)
+        waiters = [asyncio.ensure_future(stop_event.wait()), asyncio.ensure_future(TRACKER_WAKEUP.wait())]
+        await asyncio.wait(waiters, timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+        if TRACKER_WAKEUP.is_set() and not stop_event.is_set():
+            # 新提交的任务需要一点时间才会开始下载
+            interval = TRACKER_MIN_INTERVAL
             try:
-                console.log(f"检查云端文件夹 [magenta]{folder_id}[/magenta] 是否已存在文件: [blue]{title}[/blue]")
-                sub_folder_list = await client.file_list(parent_id=folder_id)
-                for sub_file in sub_folder_list.get('files', []):
-                     if (sub_file.get('name') == title or
-                        (sub_file.get('params') and sub_file['params'].get('task_name') == title) or
-                        (sub_file.get('params') and sub_file['params'].get('filename') == title)):
-                         console.log(f"[yellow]云端文件夹中已存在同名文件，跳过添加: {title}[/yellow]")
-                         # Optionally delete the downloaded torrent if it exists in the cloud folder
-                         # if os.path.exists(downloaded_path):
-                         #     os.remove(downloaded_path)
-                         #     console.log(f"[dim]已删除本地重复种子: {downloaded_path}[/dim]")
-                         return False # Already exists in folder
-            except Exception as e:
-                console.log(f"[yellow]检查云端文件夹失败: {e}，将尝试添加任务。[/yellow]")
+                await asyncio.wait_for(stop_event.wait(), timeout=TRACKER_MIN_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+# 分段下载不支持 Range 的服务器时抛出
+class RangeNotSupported(Exception):
+    pass
+
+
+# 在后台启动下载任务，服务退出时由 run_service 取消（分段进度已持久化，下次启动继续）
+def start_download(coro):
+    job = asyncio.ensure_future(coro)
+    _download_jobs.add(job)
+    job.add_done_callback(_download_jobs.discard)
+    return job
+
+
+# 下载已完成离线任务的文件到 DOWNLOAD_DIR/<发布日期>/，任务为文件夹时递归下载其中的文件
+async def download_entry(account_index, entry, file_id):
+    client = PIKPAK_CLIENTS[account_index]
+    if not client:
+        return
+    base_dir = os.path.join(DOWNLOAD_DIR, entry.get('pubdate') or "")
+    try:
+        files = await resolve_download_files(client, file_id, "")
+    except Exception as e:
+        console.log(f"[red]获取下载文件列表失败: {e}. 任务: {entry['title']}[/red]")
+        return
+    for child_id, relative_path in files:
+        await download_pikpak_file(account_index, child_id, os.path.join(base_dir, relative_path))
+
+
+# 展开文件夹，返回 [(文件 ID, 相对路径)]
+async def resolve_download_files(client, file_id, prefix):
+    info = await api_call(client.offline_file_info, file_id)
+    path = os.path.join(prefix, info.get('name') or file_id)
+    if info.get('kind') != 'drive#folder':
+        return [(file_id, path)]
+    files = []
+    for child in await list_all_pages(client.file_list, 'files', size=LISTING_PAGE_SIZE, parent_id=file_id):
+        files += await resolve_download_files(client, child['id'], path)
+    return files
+
+
+# 获取单个 PikPak 文件的下载链接并下载到 dest_path
+async def download_pikpak_file(account_index, file_id, dest_path):
+    if await asyncio.to_thread(os.path.exists, dest_path):
+        return
+    async with DOWNLOAD_SEMAPHORE:
+        try:
+            info = await api_call(PIKPAK_CLIENTS[account_index].get_download_url, file_id)
+            url = info.get('web_content_link') or ((info.get('medias') or [{}])[0].get('link') or {}).get('url')
+            if not url:
+                console.log(f"[red]未获取到下载链接: {dest_path}[/red]")
+                return
+            await download_file(
+                url, dest_path, int(info['size']) if info.get('size') else None,
+                md5=info.get('md5_checksum') or None, gcid=info.get('hash') or None,
+                account=USER[account_index], file_id=file_id,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console.log(f"[red]下载文件失败: {e}. 文件: {dest_path}[/red]")
+
+
+# 把文件切分为至多 DOWNLOAD_SEGMENTS 段，每段记录 [起点, 终点（不含）, 已下载到的位置]
+def plan_segments(size):
+    if size <= 0:
+        return [[0, 0, 0]]
+    count = max(1, min(DOWNLOAD_SEGMENTS, size // DOWNLOAD_MIN_SEGMENT_SIZE))
+    step = -(-size // count)
+    return [[start, min(start + step, size), start] for start in range(0, size, step)]
 
-            # Upload torrent
-            await magnet_upload(account_index, torrent_info, folder_id)
-            return True # Task submitted (or attempted)
+
+# 持久化分段下载进度
+def save_segment_map(dest_path, size, segments, account=None, file_id=None):
+    STATE_DB.execute(
+        "INSERT INTO downloads (path, size, segments, account, file_id, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (path) DO UPDATE SET segments = excluded.segments, updated_at = excluded.updated_at",
+        (dest_path, size, json.dumps(segments), account, file_id, time.time()),
+    )
+
+
+# 创建（或清空）.part 文件并预分配 size 字节
+def prepare_part_file(part_path, size):
+    os.makedirs(os.path.dirname(part_path) or ".", exist_ok=True)
+    with open(part_path, "wb") as f:
+        if size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+
+# .part 文件存在且大小为 size 时才能续传
+def part_file_matches(part_path, size):
+    return os.path.exists(part_path) and os.path.getsize(part_path) == size
+
+
+# 用多段并发的 Range 请求下载 url 到 dest_path：预分配 .part 文件，各段直接写入自己的偏移位置
+# 中断后按持久化的分段进度续传；完成后校验大小和 hash（md5 或 PikPak 的 gcid），再原子重命名
+# size 为 None（接口未返回大小）时不带 Range 单连接下载，不能续传
+async def download_file(url, dest_path, size, md5=None, gcid=None, account=None, file_id=None):
+    part_path = dest_path + ".part"
+    if size is None:
+        console.log(f"开始下载: [blue]{dest_path}[/blue] (大小未知，单连接下载)")
+        # 记录下来以便中断后重新下载（没有分段进度，从头开始）
+        save_segment_map(dest_path, 0, [], account, file_id)
+        await asyncio.to_thread(prepare_part_file, part_path, 0)
+        await download_stream(url, part_path)
+        await finish_download(part_path, dest_path, size, md5, gcid)
+        return
+
+    row = STATE_DB.execute("SELECT size, segments FROM downloads WHERE path = ?", (dest_path,)).fetchone()
+    if row and row["size"] == size and await asyncio.to_thread(part_file_matches, part_path, size):
+        segments = json.loads(row["segments"])
+        console.log(f"继续下载: [blue]{dest_path}[/blue] ({sum(s[2] - s[0] for s in segments) * 100 // max(size, 1)}%)")
     else:
-        # console.log(f"本地已存在种子文件: [blue]{name}[/blue]") # Reduce verbosity
-        return False # Already exists locally, no network check needed
+        segments = plan_segments(size)
+        await asyncio.to_thread(prepare_part_file, part_path, size)
+        console.log(f"开始下载: [blue]{dest_path}[/blue] ({size} 字节, {len(segments)} 段)")
+    save_segment_map(dest_path, size, segments, account, file_id)
+
+    jobs = [
+        asyncio.ensure_future(download_segment(url, part_path, segment, dest_path, size, segments))
+        for segment in segments if segment[2] < segment[1]
+    ]
+    try:
+        await asyncio.gather(*jobs)
+    except BaseException:
+        # 任一分段失败时取消其余分段，避免它们继续写入
+        for job in jobs:
+            job.cancel()
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        if not any(isinstance(result, RangeNotSupported) for result in results):
+            raise
+        console.log(f"[yellow]服务器不支持分段下载，改为单连接下载: {dest_path}[/yellow]")
+        segments[:] = [[0, size, 0]]
+        await download_segment(url, part_path, segments[0], dest_path, size, segments)
+    finally:
+        save_segment_map(dest_path, size, segments)
+    await finish_download(part_path, dest_path, size, md5, gcid)
+
+
+# 校验 .part 文件，通过后原子重命名为 dest_path，并清除分段进度
+async def finish_download(part_path, dest_path, size, md5=None, gcid=None):
+    if not await asyncio.to_thread(verify_download, part_path, size, md5, gcid):
+        await asyncio.to_thread(os.remove, part_path)
+        STATE_DB.execute("DELETE FROM downloads WHERE path = ?", (dest_path,))
+        raise ValueError("文件大小或 hash 校验失败")
+    await asyncio.to_thread(os.replace, part_path, dest_path)
+    STATE_DB.execute("DELETE FROM downloads WHERE path = ?", (dest_path,))
+    console.log(f"[green]下载完成:[/green] [blue]{dest_path}[/blue]")
+
 
+# 下载一个分段，segment[2] 随写入推进；受全局带宽限速，临时错误自动重试（从断点继续）
+async def download_segment(url, part_path, segment, dest_path, size, segments):
+    import httpx
 
+    async def attempt():
+        _, end, position = segment
+        if position >= end:
+            return
+        headers = {"Range": f"bytes={position}-{end - 1}"}
+        async with get_download_client().stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+            if response.status_code != 206 and (position != 0 or end != size):
+                raise RangeNotSupported()
+            unsaved = 0
+            f = await asyncio.to_thread(open, part_path, "r+b")
+            try:
+                await asyncio.to_thread(f.seek, position)
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    chunk = chunk[:end - segment[2]]
+                    if DOWNLOAD_RATE_LIMITER is not None:
+                        await DOWNLOAD_RATE_LIMITER.acquire(len(chunk))
+                    await asyncio.to_thread(f.write, chunk)
+                    segment[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= DOWNLOAD_CHECKPOINT_BYTES:
+                        await asyncio.to_thread(f.flush)
+                        save_segment_map(dest_path, size, segments)
+                        unsaved = 0
+                    if segment[2] >= end:
+                        break
+            finally:
+                await asyncio.to_thread(f.close)
+        if segment[2] < end:
+            raise httpx.ReadError("连接提前关闭，分段未下载完整")
+    await with_retry(attempt)
+
+
+# 大小未知时不带 Range 下载整个文件，受全局带宽限速；临时错误自动重试（从头开始）
+async def download_stream(url, part_path):
+    async def attempt():
+        async with get_download_client().stream("GET", url) as response:
+            response.raise_for_status()
+            f = await asyncio.to_thread(open, part_path, "wb")
+            try:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    if DOWNLOAD_RATE_LIMITER is not None:
+                        await DOWNLOAD_RATE_LIMITER.acquire(len(chunk))
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+    await with_retry(attempt)
+
+
+# 校验下载文件的大小（size 为 None 时不校验）和 hash
+def verify_download(path, size, md5=None, gcid=None):
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if md5:
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest().lower() == md5.lower()
+    if gcid:
+        return compute_gcid(path, os.path.getsize(path)) == gcid.upper()
+    return True
+
+
+# PikPak 文件的 gcid：按文件大小确定块大小，对各块 SHA-1 的拼接再做 SHA-1
+def compute_gcid(path, size):
+    block_size = 0x40000
+    while size / block_size > 0x200 and block_size < 0x200000:
+        block_size <<= 1
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(block_size):
+            digest.update(hashlib.sha1(chunk).digest())
+    return digest.hexdigest().upper()
+
+
+# 启动时继续上次未完成的下载（下载链接会过期，需要重新获取）
+def resume_downloads():
+    for row in STATE_DB.execute("SELECT path, account, file_id FROM downloads WHERE file_id IS NOT NULL").fetchall():
+        if row["account"] in USER and PIKPAK_CLIENTS[USER.index(row["account"])]:
+            start_download(download_pikpak_file(USER.index(row["account"]), row["file_id"], row["path"]))
+
+
+# 执行单轮检查（刷新 token + RSS 检查）后退出，供单次运行使用
 async def main():
-    console.rule("[bold blue]开始 RSS 检查[/bold blue]")
-    # 刷新 token
-    await auto_refresh_token()
+    init_scheduler()
+    try:
+        await refresh_tokens()
+        await rss_cycle()
+    finally:
+        await close_http_client()
 
-    if not PIKPAK_CLIENTS[0]:
-        console.log("[red]PikPak 客户端未初始化或登录失败，无法继续。[/red]")
-        return
 
-    # 获取 RSS 种子列表
-    mylist = await get_rss()
-    if not mylist:
+# 单次运行（--once）：先对订阅做条件请求，只有存在需要处理的条目、待跟踪的离线任务或未完成的本地下载时
+# 才创建 PikPak 客户端（导入 pikpakapi 并恢复登录状态）；返回进程退出码
+async def run_once():
+    has_downloads = DOWNLOAD_DIR and STATE_DB.execute("SELECT 1 FROM downloads WHERE file_id IS NOT NULL LIMIT 1").fetchone()
+    if not load_retry_entries() and not load_deferred_entries() and not load_tracked_entries() and not has_downloads:
+        unchanged = await asyncio.gather(*(asyncio.to_thread(feed_unchanged, feed['url']) for feed in FEEDS))
+        if all(unchanged):
+            console.log("RSS 均未更新，也没有待重试或待跟踪的条目，退出。")
+            return 0
+    init_scheduler()
+    try:
+        await rss_cycle()
+        if (load_tracked_entries() or has_downloads) and await ensure_clients():
+            if DOWNLOAD_DIR:
+                resume_downloads()
+            await track_tasks()
+        # 本地下载的分段进度已持久化，但单次运行仍等待下载完成再退出
+        await asyncio.gather(*_download_jobs, return_exceptions=True)
+    finally:
+        await close_http_client()
+        release_all_leases()
+        if any(PIKPAK_CLIENTS):
+            save_client()
+    return EXIT_FAILED if CYCLE_FAILURES else 0
+
+
+# 单次运行的快速检查：用标准库向订阅发送条件请求，返回 304 说明没有新条目
+# 不必创建 httpx 客户端（加载 httpcore 传输层并初始化 SSL 上下文），出错或没有保存的 ETag / Last-Modified 时视为已更新
+def feed_unchanged(url):
+    state = FEED_STATE.get(url, {})
+    headers = {}
+    if state.get('etag'):
+        headers["If-None-Match"] = state['etag']
+    if state.get('last_modified'):
+        headers["If-Modified-Since"] = state['last_modified']
+    if not headers:
+        return False
+    import urllib.error
+    import urllib.request
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=HTTP_TIMEOUTS["connect"]):
+            return False
+    except urllib.error.HTTPError as e:
+        return e.code == 304
+    except Exception:
+        return False
+
+
+# 按需创建 PikPak 客户端并确认 token 有效，返回是否至少有一个可用的客户端
+async def ensure_clients():
+    if not any(PIKPAK_CLIENTS):
+        init_clients()
+        load_folder_cache()
+        await refresh_tokens()
+    return any(PIKPAK_CLIENTS)
+
+
+# 记录本轮失败的订阅或条目，单次运行据此返回非零退出码
+def count_feed_failure(count=1):
+    global CYCLE_FAILURES
+    CYCLE_FAILURES += count
+
+
+# 检查所有账号的 token 是否需要刷新
+async def refresh_tokens():
+    await asyncio.gather(*(auto_refresh_token(i) for i in range(len(PIKPAK_CLIENTS))))
+
+
+# RSS 轮询调度：每个订阅按各自的发布规律决定下次轮询时间，到期的订阅合并为一轮检查
+# FEED_TRIGGER 被触发时立即轮询指定的订阅（或全部订阅）
+async def run_feed_scheduler(stop_event):
+    next_poll = {i: 0.0 for i in range(len(FEEDS))}
+    while not stop_event.is_set():
+        now = time.time()
+        due = sorted(i for i, at in next_poll.items() if at <= now)
+        if FEED_TRIGGER.is_set():
+            FEED_TRIGGER.clear()
+            due = sorted(set(due) | (_triggered_feeds or set(next_poll)))
+            _triggered_feeds.clear()
+        if due:
+            try:
+                new_counts = await rss_cycle(due)
+            except Exception:
+                console.log("[red]RSS 检查失败:[/red]")
+                console.print_exception(show_locals=False)
+                new_counts = {}
+            for i in due:
+                next_poll[i] = time.time() + next_poll_delay(i, new_counts.get(i, 0) > 0)
+            upcoming = min(next_poll, key=next_poll.get)
+            console.print(
+                f"\n下次 RSS 检查将在 [cyan]{max(0, next_poll[upcoming] - time.time()):.0f}[/cyan] 秒后进行 "
+                f"({FEEDS[upcoming]['url']})...", style="dim")
+        timeout = max(0.0, min(next_poll.values()) - time.time()) if next_poll else None
+        await wait_any((stop_event, FEED_TRIGGER), timeout)
+
+
+# 等待任一事件被触发，或超时
+async def wait_any(events, timeout=None):
+    waiters = [asyncio.ensure_future(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+# HTTP 触发立即轮询：POST /poll 轮询所有订阅，POST /poll?feed=<下标或链接> 只轮询指定订阅
+async def poll_route(target):
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query)
+    for ref in query.get("feed", []):
+        index = next((i for i, feed in enumerate(FEEDS) if feed['url'] == ref or str(i) == ref), None)
+        if index is None:
+            return 404, "text/plain", f"unknown feed: {ref}\n"
+        _triggered_feeds.add(index)
+    if FEED_TRIGGER is None:
+        return 503, "text/plain", "scheduler not running\n"
+    FEED_TRIGGER.set()
+    return 202, "text/plain", "poll scheduled\n"
+
+
+HTTP_ROUTES[("POST", "/poll")] = poll_route
+
+
+# 异步定时器：等待 initial_delay 秒后每隔 interval 秒执行一次 job，直到 stop_event 被触发；正在执行的 job 不会被打断
+async def run_periodic(name, interval, job, stop_event, initial_delay=0):
+    if initial_delay:
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=initial_delay)
+        except asyncio.TimeoutError:
+            pass
+    while not stop_event.is_set():
+        try:
+            await job()
+        except Exception:
+            console.log(f"[red]定时任务 {name} 执行失败:[/red]")
+            console.print_exception(show_locals=False)
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+# 常驻服务：在同一个事件循环中独立调度 RSS 轮询、token 刷新和离线任务状态轮询
+# 缓存、连接池和限速器在各轮之间保留；收到退出信号后等待进行中的提交完成再保存状态
+async def run_service():
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+
+    # 处理退出情况
+    def request_stop():
+        if not stop_event.is_set():
+            console.print("\n[bold yellow]接收到退出信号，等待进行中的任务完成...[/bold yellow]")
+            stop_event.set()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_stop)
+        except NotImplementedError: # Windows
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(request_stop))
+
+    init_scheduler()
+    server = None
+    try:
+        server = await start_http_server()
+        await refresh_tokens()
+        if DOWNLOAD_DIR:
+            resume_downloads()
+        jobs = [
+            asyncio.create_task(run_feed_scheduler(stop_event)),
+            asyncio.create_task(run_periodic("Token 刷新", INTERVAL_TIME_TOKEN_CHECK, refresh_tokens, stop_event, INTERVAL_TIME_TOKEN_CHECK)),
+            asyncio.create_task(run_tracker(stop_event)),
+        ]
+        await stop_event.wait()
+        _, pending = await asyncio.wait(jobs, timeout=SHUTDOWN_TIMEOUT)
+        if pending:
+            console.log(f"[yellow]等待超过 {SHUTDOWN_TIMEOUT} 秒，取消剩余任务。[/yellow]")
+            for job in pending:
+                job.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # 下载可能持续很久，直接取消，分段进度已持久化
+        for job in list(_download_jobs):
+            job.cancel()
+        await asyncio.gather(*_download_jobs, return_exceptions=True)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        await close_http_client()
+        release_all_leases()
+        console.log("正在保存状态并退出...")
+        save_client()  # 保存客户端状态
+        console.log("状态保存完毕，程序退出。")
+
+
+# 一轮完整的 RSS 检查（feed_indexes 为空时检查所有订阅），记录整轮耗时并按需输出各阶段耗时汇总
+# 返回 {订阅下标: 新条目数}
+async def rss_cycle(feed_indexes=None):
+    global CYCLE_FAILURES
+    CYCLE_FAILURES = 0
+    _cycle_timings.clear()
+    start = time.perf_counter()
+    try:
+        return await check_feeds(range(len(FEEDS)) if feed_indexes is None else feed_indexes)
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage="rss_cycle")
+        if CYCLE_SUMMARY:
+            log_cycle_summary(elapsed)
+
+
+# 条目的认领 key：有 infohash 时按 infohash，否则按 guid
+def entry_lease_key(entry):
+    return f"infohash:{entry['infohash']}" if entry.get('infohash') else f"guid:{entry['guid']}"
+
+
+# 网络阶段之前在同一个事务中认领条目，返回本实例取得 lease 的条目
+# 已由其他实例提交的条目不再处理；其他实例正在处理或超过 CLAIM_BATCH 的条目记为本实例推迟（不改动条目状态），下一轮再认领
+async def claim_entries(entries):
+    statuses = await claim_keys([entry_lease_key(entry) for entry in entries], limit=CLAIM_BATCH)
+    claimed, done, deferred = [], [], []
+    for entry in entries:
+        key = entry_lease_key(entry)
+        status = statuses.get(key, LEASE_HELD)
+        if status == LEASE_CLAIMED:
+            _claims[entry['guid']] = key
+            claimed.append(entry)
+        elif status == LEASE_DONE:
+            console.log(f"[yellow]条目已由其他实例提交，跳过: {entry['title']}[/yellow]")
+            row = STATE_DB.execute("SELECT state FROM entries WHERE guid = ?", (entry['guid'],)).fetchone()
+            if row is None or row["state"] not in (ENTRY_TASK_SUBMITTED, ENTRY_TASK_COMPLETED):
+                # 不覆盖共用状态数据库中提交方记录的任务信息，只补记本地尚未记录或仍在重试的条目
+                record_entry(entry, ENTRY_TASK_SUBMITTED, error=None)
+            DEDUP_RESULTS.inc(result="hit", source="lease")
+            done.append(entry)
+        else:
+            deferred.append(entry)
+    clear_deferred(claimed + done)
+    if deferred:
+        defer_entries(deferred)
+        console.log(f"{len(deferred)} 个条目由其他实例处理中或超过本轮认领上限，留到下一轮。")
+    return claimed
+
+
+# 结束本轮认领：同一 key 的条目有任意一个提交成功、或全部无需提交时标记为完成，有失败的则释放给其他实例重试
+# 提交成功的条目在 submit_entry 中已标记完成，这里处理其余条目
+async def finish_claims(entries, results):
+    submitted, failed = set(), set()
+    for entry, result in zip(entries, results):
+        if result is True:
+            submitted.add(_claims.get(entry['guid']))
+        elif result is None:
+            failed.add(_claims.get(entry['guid']))
+    keys = {_claims.pop(entry['guid'], None) for entry in entries} - {None}
+    try:
+        await lease_call(release_leases, [key for key in keys if key in submitted or key not in failed], done=True)
+        await lease_call(release_leases, [key for key in keys if key not in submitted and key in failed])
+    except Exception as e:
+        console.log(f"[yellow]结束认领失败: {e}[/yellow]")
+
+
+# 网络阶段期间每隔 1/3 租期续租本实例持有的认领
+async def keep_leases_alive():
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        try:
+            await lease_call(renew_leases)
+        except Exception as e:
+            console.log(f"[yellow]续租失败: {e}[/yellow]")
+
+
+# 解析 RSS -> 本地检查 -> 网络检查、下载与提交
+async def check_feeds(feed_indexes):
+    console.rule("[bold blue]开始 RSS 检查[/bold blue]")
+    # 并发获取订阅的 RSS 种子列表
+    feed_indexes = list(feed_indexes)
+    feed_entries = await asyncio.gather(*(get_rss(i) for i in feed_indexes))
+    new_counts = {i: len(entries) for i, entries in zip(feed_indexes, feed_entries)}
+    # 在任何网络请求之前按订阅规则和版本偏好过滤
+    mylist = filter_entries([entry for entries in feed_entries for entry in entries])
+    retry_entries = load_retry_entries()
+    retry_guids = {entry['guid'] for entry in retry_entries}
+    retry_entries += [entry for entry in load_deferred_entries() if entry['guid'] not in retry_guids]
+    if not mylist and not retry_entries:
         # console.log("[yellow]未能从 RSS 源获取任何条目。[/yellow]") # Message handled in get_rss
+        commit_feed_state()
         console.rule("[bold blue]RSS 检查结束[/bold blue]")
-        return
+        return new_counts
 
     # 先检查本地文件是否存在，减少重复请求次数
     console.log("开始本地检查...")
     needs_network_check_list = []
     # Use Progress for local check visualization
-    with Progress(console=console) as progress_local:
+    with make_progress() as progress_local:
         task_local_check = progress_local.add_task("[yellow]本地检查...", total=len(mylist))
         for entry in mylist:
             if entry['torrent'] == 'N/A':
                 console.log(f"[yellow]跳过无效条目 (无 torrent 链接): {entry['title']}[/yellow]")
                 progress_local.update(task_local_check, advance=1)
                 continue
-            # Pass the progress object to check_torrent for local check (though it won't be used there)
-            needs_network = await check_torrent(0, entry, "local", progress_local)
+            needs_network = await check_torrent(entry['account'], entry, "local", None)
             if needs_network:
                 needs_network_check_list.append(entry)
             progress_local.update(task_local_check, advance=1)
 
+    # 合并之前失败、仍需重试的条目
+    pending_guids = {entry['guid'] for entry in needs_network_check_list}
+    needs_network_check_list += [entry for entry in retry_entries if entry['guid'] not in pending_guids]
+
     # 如果需要下载文件，则登录（若有token，实际上是复用之前的连接状态）
+    if needs_network_check_list and not await ensure_clients():
+        count_feed_failure(len(needs_network_check_list))
+        console.log("[red]PikPak 客户端未初始化或登录失败，无法继续。[/red]")
+        return new_counts # 不推进 RSS 水位线，下一轮重新处理这些条目
+    # 认领条目，其他实例正在处理或已提交的条目不再处理；任务列表快照在认领之后拉取
+    needs_network_check_list = await claim_entries(needs_network_check_list)
     if needs_network_check_list:
         console.log(f"发现 {len(needs_network_check_list)} 个新条目需要处理，开始网络检查和下载...")
-        # await login(0) # Login is implicitly handled by token check/refresh
-
-        # Create a single Progress instance for all downloads in this run
-        with Progress(console=console) as progress_network:
-            # Use Progress for network check/download visualization
-            task_network_check = progress_network.add_task("[cyan]网络检查与下载...", total=len(needs_network_check_list))
-            tasks = []
-            for entry in needs_network_check_list:
-                # Pass the single progress_network object to check_torrent
-                tasks.append(check_torrent(0, entry, "network", progress_network))
-                # No need to update task_network_check here, download_torrent handles its own task
-
-            results = await asyncio.gather(*tasks)
-            # Update the main task after all downloads are attempted/done
-            progress_network.update(task_network_check, completed=len(needs_network_check_list))
+
+        results = [None] * len(needs_network_check_list)
+        renewer = asyncio.create_task(keep_leases_alive())
+        try:
+            # 整轮每个账号只拉取一次离线任务列表，所有条目共用同一份索引快照
+            TASK_INDEXES[:] = await asyncio.gather(*(build_task_index(i) for i in range(len(PIKPAK_CLIENTS))))
+            accounts = assign_accounts(needs_network_check_list)
+
+            # Create a single Progress instance for all downloads in this run
+            with make_progress() as progress_network:
+                # Use Progress for network check/download visualization
+                task_network_check = progress_network.add_task("[cyan]网络检查与下载...", total=len(needs_network_check_list))
+                # 所有种子下载共用一个按字节汇总的进度条
+                transfers = TransferProgress(progress_network, "[cyan]下载种子...")
+                tasks = []
+                for account_index, entry in zip(accounts, needs_network_check_list):
+                    tasks.append(check_torrent(account_index, entry, "network", transfers))
+
+                results = await asyncio.gather(*tasks)
+                # Update the main task after all downloads are attempted/done
+                progress_network.update(task_network_check, completed=len(needs_network_check_list))
+        finally:
+            renewer.cancel()
+            await finish_claims(needs_network_check_list, results)
 
         successful_uploads = sum(1 for r in results if r is True)
-        failed_or_skipped = len(needs_network_check_list) - successful_uploads
-        console.log(f"网络检查与下载完成: {successful_uploads} 个任务成功提交/跳过，{failed_or_skipped} 个失败/已存在。")
+        skipped = sum(1 for r in results if r is False)
+        failed = sum(1 for r in results if r is None)
+        count_feed_failure(failed)
+        console.log(f"网络检查与下载完成: {successful_uploads} 个任务成功提交，{skipped} 个已存在，{failed} 个失败 (将在下一轮重试)。")
     else:
         console.log("本地检查完成，没有发现需要下载的新条目。")
 
+    # 新条目已全部处理（失败的已进入重试队列），推进 RSS 水位线
+    commit_feed_state()
     console.rule("[bold blue]RSS 检查结束[/bold blue]")
+    return new_counts
+
+
+# 输出结构化事件（仅无终端模式；交互模式下由 console.log 展示）
+def emit_event(event, level=logging.INFO, **fields):
+    if HEADLESS:
+        EVENT_LOGGER.log(level, event, extra={"event": event, "fields": fields})
+
+
+# 去掉 console.log 消息中的 Rich 样式标记
+def strip_markup(message):
+    return CONSOLE_MARKUP_PATTERN.sub("", message)
+
+
+# 无终端模式下替代 Rich Console：不做任何渲染，错误消息转为 error 事件，其余消息降为 DEBUG 日志
+class HeadlessConsole:
+    quiet = False
+
+    def log(self, *objects, **kwargs):
+        message = " ".join(str(obj) for obj in objects)
+        if "[red]" in message or "[bold red]" in message:
+            emit_event("error", logging.ERROR, message=strip_markup(message).strip())
+        elif EVENT_LOGGER.isEnabledFor(logging.DEBUG):
+            EVENT_LOGGER.debug(strip_markup(message).strip())
+
+    print = log
+
+    def rule(self, *args, **kwargs):
+        pass
+
+    def input(self, prompt="", password=False):
+        raise RuntimeError(f"无终端模式下无法交互输入: {strip_markup(prompt)}")
+
+    def print_exception(self, **kwargs):
+        emit_event("error", logging.ERROR, message=traceback.format_exc())
+
+
+# 按事件类型限速的日志过滤器（令牌桶），被丢弃的条数记在该类型下一条事件的 dropped 字段中
+class EventRateLimitFilter(logging.Filter):
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # 事件类型 -> (令牌数, 更新时间, 已丢弃条数)
+
+    def filter(self, record):
+        event = getattr(record, "event", "log")
+        now = time.monotonic()
+        tokens, updated, dropped = self.buckets.get(event, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[event] = (tokens, now, dropped + 1)
+            return False
+        record.dropped = dropped
+        self.buckets[event] = (tokens - 1, now, 0)
+        return True
+
+
+# 每条日志输出为一行 JSON
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "event": getattr(record, "event", "log"),
+        }
+        fields = getattr(record, "fields", None)
+        if fields is None:
+            data["message"] = record.getMessage()
+        else:
+            data.update(fields)
+        if getattr(record, "dropped", 0):
+            data["dropped"] = record.dropped
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+# 切换到无终端模式
+def enable_headless():
+    global HEADLESS, console
+    HEADLESS = True
+    console = HeadlessConsole()
+
+
+# 创建进度条，无终端模式下不渲染
+def make_progress():
+    from rich.progress import Progress
+    return Progress(console=None if HEADLESS else console.rich, disable=HEADLESS)
 
 
 def setup_logging(
@@ -472,12 +3099,21 @@ def setup_logging(
     # max_bytes=10*1024*1024,  # Handled by Rich
     # backup_count=5
 ):
-    """配置日志系统 (使用 RichHandler)"""
+    """配置日志系统 (交互模式使用 RichHandler，无终端模式输出限速的 JSON Lines 事件)"""
+    if HEADLESS:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonLinesFormatter())
+        handler.addFilter(EventRateLimitFilter(EVENT_RATE_LIMIT, EVENT_RATE_BURST))
+        logging.basicConfig(level=log_level, handlers=[handler])
+        # httpx 每个请求都会记一条 INFO 日志
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        return
+    from rich.logging import RichHandler
     logging.basicConfig(
         level=log_level,
         format="%(message)s", # Rich handles formatting
         datefmt="[%X]",
-        handlers=[RichHandler(console=console, rich_tracebacks=True, markup=True)] # Use Rich handler
+        handlers=[RichHandler(console=console.rich, rich_tracebacks=True, markup=True)] # Use Rich handler
     )
     # Removed file handler section causing the error
     # logger = logging.getLogger("rich") # Get logger instance
@@ -486,44 +3122,59 @@ def setup_logging(
 
 # --- Main Execution --- #
 
+# 解析命令行参数
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PikPak RSS 下载器")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--headless", action="store_true", help="无终端模式：不渲染 Rich 界面，以 JSON Lines 输出事件，配置只从 config.json 或环境变量读取")
+    mode.add_argument("--interactive", action="store_true", help="强制使用交互式 Rich 界面（标准输出不是终端时默认为无终端模式）")
+    parser.add_argument("--once", action="store_true", help="只执行一轮检查后退出（供 cron / systemd timer 使用）：不交互输入配置，RSS 未更新时不登录 PikPak；退出码 0 成功，1 有失败，2 配置不完整")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    # Initialize console early for any startup messages
-    # console = Console()
+    args = parse_args()
+    if args.headless or (not args.interactive and not sys.stdout.isatty()):
+        enable_headless()
+    ONE_SHOT = args.once
 
     setup_logging()
+    open_state_db()
     load_config()
+    open_lease_db()
+    if ONE_SHOT:
+        load_feed_state()
+        try:
+            exit_code = asyncio.run(run_once())
+        except Exception:
+            console.print_exception(show_locals=False)
+            exit_code = EXIT_FAILED
+        sys.exit(exit_code)
     init_clients()
+    load_folder_cache()
+    load_feed_state()
     # update_config() # Update config only if changed, perhaps via arguments later
 
-    # 处理退出情况
-    def signal_handler(sig, frame):
-        console.print("\n[bold yellow]接收到退出信号...[/bold yellow]")
-        console.log("正在保存状态并退出...")
-        save_client()  # 保存客户端状态
-        # update_config() # Avoid unnecessary config writes on exit
-        console.log("状态保存完毕，程序退出。")
-        sys.exit(0)
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
     console.rule("[bold green]PikPak RSS 下载器启动[/bold green]")
-    console.print(f"用户: [cyan]{USER[0]}[/cyan]")
-    console.print(f"RSS源: [link={RSS[0]}]{RSS[0]}[/link]")
-    console.print(f"检查间隔 (RSS): {INTERVAL_TIME_RSS} 秒")
-    console.print(f"检查间隔 (Token Refresh): {INTERVAL_TIME_REFRESH / 3600:.1f} 小时")
-    console.print(f"PikPak 路径 ID: [yellow]{PATH[0]}[/yellow]")
+    for i in range(len(USER)):
+        console.print(f"用户: [cyan]{USER[i]}[/cyan]  PikPak 路径 ID: [yellow]{PATH[i]}[/yellow]")
+    for feed in FEEDS:
+        account = USER[feed['account']] if feed['account'] is not None else "自动分配"
+        console.print(f"RSS源: [link={feed['url']}]{feed['url']}[/link]  账号: [cyan]{account}[/cyan]")
+    console.print(f"检查间隔 (RSS): 按订阅发布规律 {FEED_MIN_INTERVAL}-{FEED_MAX_INTERVAL} 秒 (规律未知时 {INTERVAL_TIME_RSS} 秒)")
+    console.print(
+        f"Token 刷新: 每 {INTERVAL_TIME_TOKEN_CHECK} 秒检查一次，在过期前 {TOKEN_REFRESH_MARGIN // 60} 分钟刷新"
+        f" (无法读取过期时间时每 {INTERVAL_TIME_REFRESH / 3600:.1f} 小时)"
+    )
     console.print("-" * 30) # Simple separator
 
     try:
-        while True:
-            asyncio.run(main())
-            console.print(f"\n下次 RSS 检查将在 [cyan]{INTERVAL_TIME_RSS}[/cyan] 秒后进行...", style="dim")
-            time.sleep(INTERVAL_TIME_RSS)
+        asyncio.run(run_service())
     except KeyboardInterrupt:
         console.print("\n[yellow]用户手动中断。[/yellow]")
-        signal_handler(signal.SIGINT, None) # Call handler to save state
+        save_client()
     except Exception as e:
         console.print("\n[bold red]发生未处理的异常:[/bold red]")
         console.print_exception(show_locals=False) # Use rich's exception printing
         save_client() # Attempt to save state on unexpected error
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,181 @@
+"""用 benchmark.py 中的假 PikPak API 和假 RSS 服务器测试 main.py 的完整流程（不访问网络）
+
+运行: python -m pytest -q
+"""
+import asyncio
+import os
+
+import httpx
+
+import benchmark
+import main
+
+
+# 建立场景：不加延迟、不注入错误；download_size 为假服务器 /file/ 返回的文件大小
+def setup(feeds=1, entries=6, download_size=0, fetch_torrents=False):
+    args = benchmark.parse_args(["--latency", "0", "--rss-latency", "0", *(["--fetch-torrents"] if fetch_torrents else [])])
+    server = benchmark.setup_scenario(args, feeds, entries)
+    server.download_size = download_size
+    return server
+
+
+# 超过认领上限而推迟的条目在实例重启（进程号变化）后仍会被认领提交
+def test_deferred_entries_survive_restart(monkeypatch):
+    server = setup(1, 6)
+    monkeypatch.setattr(main, "CLAIM_BATCH", 2)
+    for pid in range(3):
+        monkeypatch.setattr(main, "INSTANCE_ID", f"bench:{pid}")
+        asyncio.run(benchmark.run_cycle(server))
+        main.release_all_leases()
+    assert len(main.PIKPAK_CLIENTS[0].tasks) == 6
+    assert main.load_deferred_entries() == []
+    states = main.STATE_DB.execute("SELECT DISTINCT state FROM entries").fetchall()
+    assert [row["state"] for row in states] == [main.ENTRY_TASK_SUBMITTED]
+
+
+# 提交一轮任务后把假任务标记为完成，运行一次任务状态轮询
+def track_completed_tasks(server):
+    asyncio.run(benchmark.run_cycle(server))
+    for task in main.PIKPAK_CLIENTS[0].tasks:
+        task.update(phase="PHASE_TYPE_COMPLETE", progress=100)
+
+    async def run():
+        main.init_scheduler()
+        await main.track_tasks()
+    asyncio.run(run())
+
+
+# 任务已由其他实例执行完成回调（认领为 done）时停止跟踪，不再执行回调
+def test_track_tasks_stops_tracking_tasks_done_elsewhere(monkeypatch):
+    server = setup(1, 3)
+    hooks = []
+
+    async def hook(entry, task):
+        hooks.append(task["id"])
+    monkeypatch.setattr(main, "COMPLETION_HOOKS", [hook])
+    asyncio.run(benchmark.run_cycle(server))
+    task_ids = [task["id"] for task in main.PIKPAK_CLIENTS[0].tasks]
+    main.LEASE_DB.executemany(
+        "INSERT INTO claims (key, owner, expires_at, done, updated_at) VALUES (?, 'other:1', 0, 1, 0)",
+        [(f"task:{task_id}",) for task_id in task_ids],
+    )
+    track_completed_tasks(server)
+    assert hooks == []
+    assert main.load_tracked_entries() == []
+
+
+# 状态轮询合并任务列表，不丢弃本轮刚提交、列表快照中还没有的任务
+def test_track_tasks_merges_task_index():
+    server = setup(1, 3)
+    asyncio.run(benchmark.run_cycle(server))
+    main.TASK_INDEXES[0].add({"id": "task-new", "phase": "PHASE_TYPE_RUNNING", "params": {"url": "magnet:?xt=urn:btih:" + "0" * 40}})
+    track_completed_tasks(server)
+    assert main.find_task_by_id("task-new")[0] is not None
+    assert main.TASK_INDEXES[0].active == 1
+    assert len(main.load_tracked_entries()) == 0
+
+
+# 队列深度指标按自己的计数器统计等待信号量的协程
+def test_semaphore_waiters():
+    async def run():
+        semaphore = main.CountingSemaphore(1)
+        async with semaphore:
+            waiters = [asyncio.create_task(semaphore.acquire()) for _ in range(3)]
+            await asyncio.sleep(0)
+            assert main.semaphore_waiters(semaphore) == 3
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+        assert main.semaphore_waiters(semaphore) == 0
+    asyncio.run(run())
+
+
+# 认领在工作线程中执行，接管和认领结果回到事件循环后才计入指标
+def test_claim_keys_counts_takeovers():
+    setup()
+    main.LEASE_DB.execute("INSERT INTO claims (key, owner, expires_at, done, updated_at) VALUES ('k1', 'other:1', 0, 0, 0)")
+    before = dict(main.LEASE_CLAIMS.values)
+    statuses = asyncio.run(main.claim_keys(["k1", "k2"]))
+    assert statuses == {"k1": main.LEASE_CLAIMED, "k2": main.LEASE_CLAIMED}
+    counts = {key: value - before.get(key, 0) for key, value in main.LEASE_CLAIMS.values.items()}
+    assert counts[(("result", "takeover"),)] == 1
+    assert counts[(("result", main.LEASE_CLAIMED),)] == 2
+
+
+# save_torrents 开启时另存种子文件：大种子边下载边写入临时文件，小种子下载完成后写入，都原子重命名
+def test_save_torrent_files(monkeypatch, tmp_path):
+    for spool_size in (0, 1024 * 1024):
+        # 新建状态数据库时会把 TORRENT_DIR 中的种子导入为已处理，先切换目录
+        torrent_dir = tmp_path / str(spool_size)
+        monkeypatch.setattr(main, "TORRENT_DIR", str(torrent_dir))
+        server = setup(1, 4, fetch_torrents=True)
+        monkeypatch.setattr(main, "SAVE_TORRENT_FILES", True)
+        monkeypatch.setattr(main, "TORRENT_SPOOL_SIZE", spool_size)
+        asyncio.run(benchmark.run_cycle(server))
+        assert sorted(os.listdir(torrent_dir)) == [f"{index}.torrent" for index in range(4)]
+        for index in range(4):
+            assert (torrent_dir / f"{index}.torrent").read_bytes() == server.render_torrent(0, index)
+    main.apply_config({"save_torrents": False})
+    assert not main.SAVE_TORRENT_FILES
+    main.apply_config({"save_torrents": True})
+    assert main.SAVE_TORRENT_FILES
+
+
+# 用假服务器的 /file/ 下载一个文件；segments 为预先写入的分段进度（模拟上次中断）
+def download(monkeypatch, tmp_path, server, size, segments=None):
+    monkeypatch.setattr(main, "DOWNLOAD_SEGMENTS", 4)
+    monkeypatch.setattr(main, "DOWNLOAD_MIN_SEGMENT_SIZE", 64 * 1024)
+    monkeypatch.setattr(main, "RETRY_BASE_DELAY", 0)
+    dest_path = str(tmp_path / "show" / "file.mkv")
+    if segments is not None:
+        main.prepare_part_file(dest_path + ".part", size)
+        content = benchmark.file_content("file-1", size)
+        with open(dest_path + ".part", "r+b") as f:
+            for start, _, position in segments:
+                f.seek(start)
+                f.write(content[start:position])
+        main.save_segment_map(dest_path, size, segments, "bench0@example.com", "file-1")
+
+    async def run():
+        main.DOWNLOAD_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(server.handle))
+        try:
+            await main.download_file(f"http://{benchmark.BENCH_HOST}/file/file-1", dest_path, size)
+        finally:
+            await main.close_http_client()
+    asyncio.run(run())
+    with open(dest_path, "rb") as f:
+        assert f.read() == benchmark.file_content("file-1", server.download_size)
+    assert main.STATE_DB.execute("SELECT 1 FROM downloads").fetchone() is None
+
+
+# 分段并发下载，每段第一次响应中途断开后从断点重试
+def test_download_segments_retry(monkeypatch, tmp_path):
+    server = setup(download_size=300_000)
+    server.drop_rate = 1.0
+    download(monkeypatch, tmp_path, server, 300_000)
+    assert server.requests["file_dropped"] == 4
+    assert len(server.ranges_requested) == 8
+
+
+# 按持久化的分段进度续传，只请求每段剩余的部分
+def test_download_resumes_segments(monkeypatch, tmp_path):
+    server = setup(download_size=300_000)
+    segments = [[0, 75_000, 75_000], [75_000, 150_000, 100_000], [150_000, 225_000, 150_000], [225_000, 300_000, 299_000]]
+    download(monkeypatch, tmp_path, server, 300_000, segments)
+    assert server.ranges_requested == ["bytes=100000-149999", "bytes=150000-224999", "bytes=299000-299999"]
+
+
+# 服务器不支持 Range 时改为单连接下载
+def test_download_without_range_support(monkeypatch, tmp_path):
+    server = setup(download_size=300_000)
+    server.ranges = False
+    download(monkeypatch, tmp_path, server, 300_000)
+
+
+# 大小未知时不带 Range 下载；空文件不分段
+def test_download_unknown_and_empty_size(monkeypatch, tmp_path):
+    server = setup(download_size=100_000)
+    download(monkeypatch, tmp_path, server, None)
+    assert server.ranges_requested == []
+    server = setup(download_size=0)
+    download(monkeypatch, tmp_path / "empty", server, 0)